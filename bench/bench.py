@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmark server.py end to end, offline: starts fake_ollama.py and a copy of
+server.py in a scratch directory (seeded with history items and an Ollama log),
+runs each loadgen.py scenario against it and prints throughput, latency
+percentiles and the server's peak RSS.
+
+    python3 bench/bench.py                        # threading server
+    python3 bench/bench.py --server asyncio --json after.json --baseline before.json
+
+With --baseline the run exits non-zero if any scenario's throughput, p95
+latency or peak RSS is worse than the baseline by more than --tolerance.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from fake_ollama import make_png
+from loadgen import SCENARIOS, LoadGenerator, format_report, read_memory_kb
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_history(history_dir, count, model, flat=False):
+    """
+    Write count history items (JSON + PNG) in the server's on-disk format:
+    YYYY/MM/DD folders, or the old flat layout (migrated by the server at startup).
+    """
+    history_dir.mkdir(parents=True, exist_ok=True)
+    png = make_png(64, 64)
+    start = datetime(2024, 1, 1)
+    for n in range(count):
+        created = start + timedelta(minutes=n * 7)
+        if flat:
+            image_name = created.strftime("%Y%m%d%H%M%S")
+            item_dir = history_dir
+        else:
+            image_name = f"{created:%Y%m%d%H%M%S}-{n % 1000000:06d}00"
+            item_dir = history_dir / f"{created:%Y}" / f"{created:%m}" / f"{created:%d}"
+            item_dir.mkdir(parents=True, exist_ok=True)
+        (item_dir / f"{image_name}.png").write_bytes(png)
+        metadata = {"id": image_name, "timestamp": created.isoformat(),
+                    "settings": {"model": model, "prompt": f"seeded history item {n}", "seed": n + 1,
+                                 "width": 512, "height": 512, "steps": 8}}
+        (item_dir / f"{image_name}.json").write_text(json.dumps(metadata))
+
+
+def write_ollama_log(log_path, megabytes):
+    """An Ollama-style server log of roughly the given size, with a WARN line near the start."""
+    line = ('time=2024-01-01T00:00:00.000Z level=INFO source=server.go:123 '
+            'msg="benchmark filler line" model=x/z-image-turbo:fp8 step=1\n')
+    with open(log_path, "w") as f:
+        f.write('time=2024-01-01T00:00:00.000Z level=WARN source=server.go:1 msg="benchmark warning"\n')
+        f.write(line * max(1, int(megabytes * 1024 * 1024 / len(line))))
+
+
+def wait_until_up(url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def compare(summaries, baseline, tolerance):
+    """Return a list of regressions against a baseline run's summaries."""
+    regressions = []
+    for name, s in summaries.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before["throughput"] and s["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {s['throughput']:.1f}/s, was {before['throughput']:.1f}/s")
+        if before["p95"] and s["p95"] is not None and s["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {s['p95'] * 1000:.1f} ms, was {before['p95'] * 1000:.1f} ms")
+        if before.get("peak_rss_kb") and s.get("peak_rss_kb") and s["peak_rss_kb"] > before["peak_rss_kb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {s['peak_rss_kb'] / 1024:.1f} MB, "
+                               f"was {before['peak_rss_kb'] / 1024:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server.py against a fake Ollama")
+    parser.add_argument("--server", choices=("threading", "asyncio"), default="threading")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append",
+                        help="scenario to run (repeatable; default: all, in order)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent generate clients")
+    parser.add_argument("--read-concurrency", type=int, default=32, help="concurrent clients for the read routes")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per read scenario")
+    parser.add_argument("--generate-requests", type=int, default=32)
+    parser.add_argument("--history-items", type=int, default=2000, help="history items to seed")
+    parser.add_argument("--flat-history", action="store_true",
+                        help="seed the old flat history layout, so the server migrates it while under load")
+    parser.add_argument("--log-mb", type=float, default=50, help="size of the Ollama log to seed")
+    parser.add_argument("--steps", type=int, default=8, help="progress lines per generation")
+    parser.add_argument("--step-delay", type=float, default=0.02, help="fake Ollama seconds per step")
+    parser.add_argument("--image-size", type=int, default=1024, help="fake Ollama image width and height")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra argument for server.py")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional regression")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+    model = "x/z-image-turbo:fp8"
+
+    scratch = Path(tempfile.mkdtemp(prefix="oig-bench-"))
+    processes = []
+    try:
+        shutil.copy(REPO_DIR / "server.py", scratch / "server.py")
+        shutil.copy(REPO_DIR / "index.html", scratch / "index.html")
+        print(f"Seeding {args.history_items} history items and a {args.log_mb:g} MB Ollama log in {scratch}")
+        seed_history(scratch / "history", args.history_items, model, args.flat_history)
+        write_ollama_log(scratch / "ollama.log", args.log_mb)
+
+        ollama_port = free_port()
+        server_port = free_port()
+        ollama = subprocess.Popen(
+            [sys.executable, str(BENCH_DIR / "fake_ollama.py"), "--port", str(ollama_port),
+             "--steps", str(args.steps), "--step-delay", str(args.step_delay),
+             "--image-size", str(args.image_size), "--load-delay", "0"],
+            stdout=subprocess.DEVNULL)
+        processes.append(ollama)
+        wait_until_up(f"http://127.0.0.1:{ollama_port}/api/tags", ollama)
+
+        with open(scratch / "server.log", "w") as server_log:
+            server = subprocess.Popen(
+                [sys.executable, "server.py", "--server", args.server, "--port", str(server_port),
+                 "--ollama-url", f"http://127.0.0.1:{ollama_port}/api",
+                 "--ollama-log", str(scratch / "ollama.log")] + args.server_arg,
+                cwd=scratch, stdout=server_log, stderr=subprocess.STDOUT)
+        processes.append(server)
+        wait_until_up(f"http://127.0.0.1:{server_port}/queue", server)
+        rss, _ = read_memory_kb(server.pid)
+        if rss:
+            print(f"Server ({args.server}) started, RSS {rss / 1024:.1f} MB")
+
+        async def run_all():
+            generator = LoadGenerator(f"http://127.0.0.1:{server_port}", model, args.steps)
+            summaries = {}
+            for scenario in args.scenario or SCENARIOS:
+                generating = scenario.startswith("generate")
+                print(f"  running {scenario}...", flush=True)
+                result = await generator.run(
+                    scenario, args.concurrency if generating else args.read_concurrency,
+                    duration=None if generating else args.duration,
+                    requests=args.generate_requests if generating else None,
+                    server_pid=server.pid)
+                summaries[scenario] = result.summary()
+            return summaries
+
+        random.seed(0)
+        summaries = asyncio.run(run_all())
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep:
+            print(f"Scratch directory kept: {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    print()
+    print(format_report(summaries))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"server": args.server, "options": vars(args), "scenarios": summaries}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summaries, json.load(f)["scenarios"], args.tolerance)
+        if regressions:
+            print("\nRegressions against", args.baseline)
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
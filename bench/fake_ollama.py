@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the Ollama API, for benchmarking server.py offline on a CPU-only box.
+Serves /api/tags, /api/ps and a streaming /api/generate: a line of progress per
+step, then a final line carrying a base64 PNG (random pixels, so it is as large
+as a real image of that size and does not compress away).
+"""
+
+import argparse
+import base64
+import json
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_MODELS = ["x/z-image-turbo:fp8", "x/flux2-klein:4b"]
+
+
+def make_png(width, height):
+    """An 8-bit RGB PNG of random pixels."""
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(chunk_type, payload):
+        return (struct.pack(">I", len(payload)) + chunk_type + payload
+                + struct.pack(">I", zlib.crc32(chunk_type + payload) & 0xffffffff))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1))
+            + chunk(b"IEND", b""))
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive and chunked streaming, like Ollama
+    options = None  # argparse namespace, set by main()
+    image_base64 = None
+    loaded_model = None
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json({"models": [{"name": name, "model": name, "size": 0} for name in self.options.models]})
+        elif self.path == "/api/ps":
+            loaded = FakeOllamaHandler.loaded_model
+            self.send_json({"models": [{"name": loaded, "model": loaded}] if loaded else []})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_json({"error": "invalid JSON"}, 400)
+            return
+        if self.path != "/api/generate":
+            self.send_json({"error": "not found"}, 404)
+            return
+        model = request.get("model", "")
+        if model not in self.options.models:
+            self.send_json({"error": f"model '{model}' not found"}, 404)
+            return
+
+        started = time.monotonic()
+        load_seconds = 0.0
+        if FakeOllamaHandler.loaded_model != model:
+            load_seconds = self.options.load_delay
+            time.sleep(load_seconds)
+            FakeOllamaHandler.loaded_model = model
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        # An empty prompt only loads the model, as with the real API
+        steps = int(request.get("steps", self.options.steps)) if request.get("prompt") else 0
+        for step in range(1, steps + 1):
+            time.sleep(self.options.step_delay)
+            self.send_line({"model": model, "created_at": self.timestamp(), "completed": step,
+                            "total": steps, "done": False})
+
+        final = {"model": model, "created_at": self.timestamp(), "response": "", "done": True,
+                 "done_reason": "stop" if steps else "load",
+                 "total_duration": int((time.monotonic() - started) * 1e9),
+                 "load_duration": int(load_seconds * 1e9)}
+        if steps:
+            final["image"] = self.image_base64
+        self.send_line(final)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def send_line(self, data):
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def timestamp():
+        return datetime.now(timezone.utc).isoformat()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama API for benchmarking server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, help="model names to report and accept")
+    parser.add_argument("--steps", type=int, default=8, help="progress lines when the request has no steps")
+    parser.add_argument("--step-delay", type=float, default=0.05, help="seconds between progress lines")
+    parser.add_argument("--load-delay", type=float, default=0.5, help="seconds to 'load' a model that is not loaded")
+    parser.add_argument("--image-size", type=int, default=1024, help="width and height of the returned PNG")
+    args = parser.parse_args()
+
+    FakeOllamaHandler.options = args
+    FakeOllamaHandler.image_base64 = base64.b64encode(make_png(args.image_size, args.image_size)).decode("ascii")
+    server = ThreadingHTTPServer((args.host, args.port), FakeOllamaHandler)
+    server.daemon_threads = True
+    print(f"Fake Ollama on http://{args.host}:{args.port}/api "
+          f"({len(FakeOllamaHandler.image_base64) / 1e6:.1f} MB image lines)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
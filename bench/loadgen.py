@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Load generator for server.py. Drives one route at a time at a fixed concurrency
+and reports throughput, latency percentiles and (given the server's pid) its
+resident memory. Can be pointed at any running server, or used by bench.py.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+SCENARIOS = ("generate", "generate_cached", "history_index", "history_item", "history_image", "ollamalog")
+READ_SIZE = 256 * 1024
+
+
+class ScenarioResult:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies = []  # Seconds, successful requests only
+        self.first_byte = []  # Seconds to the first byte of the response body
+        self.statuses = Counter()
+        self.errors = 0
+        self.bytes_received = 0
+        self.elapsed = 0.0
+        self.peak_rss_kb = None
+
+    def summary(self):
+        completed = len(self.latencies)
+        return {
+            "concurrency": self.concurrency,
+            "requests": completed + self.errors,
+            "errors": self.errors,
+            "statuses": dict(self.statuses),
+            "throughput": completed / self.elapsed if self.elapsed else 0.0,
+            "p50": percentile(self.latencies, 50),
+            "p95": percentile(self.latencies, 95),
+            "p99": percentile(self.latencies, 99),
+            "first_byte_p50": percentile(self.first_byte, 50),
+            "mb_per_second": self.bytes_received / 1e6 / self.elapsed if self.elapsed else 0.0,
+            "peak_rss_kb": self.peak_rss_kb,
+        }
+
+
+def percentile(values, p):
+    """Nearest-rank percentile, or None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))  # ceil without floats
+    return ordered[int(rank) - 1]
+
+
+def read_memory_kb(pid):
+    """Return (current RSS, peak RSS) of a process in kB from /proc, or (None, None)."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+async def fetch(host, port, method, path, body=b""):
+    """
+    Make one HTTP/1.0 request and read the whole response without keeping it.
+    Returns (status, seconds to first body byte, total seconds, body bytes, stream error seen).
+    """
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        head = f"{method} {path} HTTP/1.0\r\nHost: {host}:{port}\r\n"
+        if body:
+            head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        await reader.readuntil(b"\r\n\r\n")
+        first_byte = None
+        received = 0
+        stream_error = False
+        tail = b""
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            if first_byte is None:
+                first_byte = time.monotonic() - started
+            received += len(data)
+            # base64 and progress lines never contain '{"error"', so this cannot misfire
+            stream_error = stream_error or b'{"error"' in tail + data
+            tail = data[-16:]
+        return status, first_byte, time.monotonic() - started, received, stream_error
+    finally:
+        writer.close()
+
+
+class LoadGenerator:
+    def __init__(self, base_url, model, steps=8):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.model = model
+        self.steps = steps
+        self.history_ids = []
+        self.run_id = f"{time.time():.0f}"
+
+    async def discover_history(self, limit=500):
+        """Remember some history ids for the per-item scenarios."""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"GET /history/index?limit={limit} HTTP/1.0\r\n\r\n".encode("latin-1"))
+            response = await reader.read()
+        finally:
+            writer.close()
+        _, _, body = response.partition(b"\r\n\r\n")
+        try:
+            self.history_ids = [item["id"] for item in json.loads(body)]
+        except (ValueError, KeyError, TypeError):
+            self.history_ids = []
+        return len(self.history_ids)
+
+    def request_for(self, scenario, n):
+        """Return (method, path, body) for request number n of a scenario."""
+        if scenario == "generate":
+            body = {"model": self.model, "prompt": f"benchmark {self.run_id} request {n}",
+                    "steps": self.steps, "width": 512, "height": 512, "seed": 0}
+            return "POST", "/generate", json.dumps(body).encode("utf-8")
+        if scenario == "generate_cached":
+            body = {"model": self.model, "prompt": f"benchmark {self.run_id} cached",
+                    "steps": self.steps, "width": 512, "height": 512, "seed": 1234}
+            return "POST", "/generate", json.dumps(body).encode("utf-8")
+        if scenario == "history_index":
+            return "GET", "/history/index", b""
+        if scenario == "history_item":
+            return "GET", f"/history/{random.choice(self.history_ids)}", b""
+        if scenario == "history_image":
+            return "GET", f"/history/{random.choice(self.history_ids)}.png", b""
+        if scenario == "ollamalog":
+            return "GET", "/ollamalog/warn" if n % 2 else "/ollamalog/info", b""
+        raise ValueError(f"unknown scenario {scenario}")
+
+    async def run(self, scenario, concurrency, duration=None, requests=None, server_pid=None):
+        """Run a scenario for a number of seconds, or until a number of requests are made."""
+        if scenario in ("history_item", "history_image") and not self.history_ids:
+            await self.discover_history()
+            if not self.history_ids:
+                raise RuntimeError(f"{scenario} needs history items; run generate first")
+        if scenario == "generate_cached":
+            await fetch(self.host, self.port, *self.request_for(scenario, 0))  # Prime the cache
+
+        result = ScenarioResult(scenario, concurrency)
+        counter = iter(range(requests if requests is not None else 2 ** 62))
+        deadline = None if duration is None else time.monotonic() + duration
+
+        async def worker():
+            for n in counter:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                try:
+                    status, first_byte, total, received, stream_error = await fetch(
+                        self.host, self.port, *self.request_for(scenario, n))
+                except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    result.errors += 1
+                    result.statuses["connection error"] += 1
+                    continue
+                result.statuses[status] += 1
+                result.bytes_received += received
+                if status >= 400 or stream_error:
+                    result.errors += 1
+                    continue
+                result.latencies.append(total)
+                if first_byte is not None:
+                    result.first_byte.append(first_byte)
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.elapsed = time.monotonic() - started
+        if server_pid:
+            result.peak_rss_kb = read_memory_kb(server_pid)[1]
+        return result
+
+
+def format_milliseconds(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def format_report(summaries):
+    """A plain-text table of scenario summaries (name -> summary dict)."""
+    header = (f"{'scenario':<16}{'conc':>5}{'reqs':>7}{'errors':>7}{'req/s':>9}{'p50 ms':>10}"
+              f"{'p95 ms':>10}{'p99 ms':>10}{'ttfb p50':>10}{'MB/s':>8}{'peak RSS MB':>13}")
+    lines = [header, "-" * len(header)]
+    for name, s in summaries.items():
+        rss = "-" if s.get("peak_rss_kb") is None else f"{s['peak_rss_kb'] / 1024:.1f}"
+        lines.append(f"{name:<16}{s['concurrency']:>5}{s['requests']:>7}{s['errors']:>7}{s['throughput']:>9.1f}"
+                     f"{format_milliseconds(s['p50']):>10}{format_milliseconds(s['p95']):>10}"
+                     f"{format_milliseconds(s['p99']):>10}{format_milliseconds(s['first_byte_p50']):>10}"
+                     f"{s['mb_per_second']:>8.1f}{rss:>13}")
+    for name, s in summaries.items():
+        if s["errors"]:
+            lines.append(f"{name}: responses {s['statuses']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the Ollama Image Generator server")
+    parser.add_argument("--url", default="http://localhost:8080", help="server to load")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append",
+                        help="route to drive (repeatable; default: all)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per read scenario")
+    parser.add_argument("--generate-requests", type=int, default=32, help="requests per generate scenario")
+    parser.add_argument("--model", default="x/z-image-turbo:fp8")
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--server-pid", type=int, help="report this process's peak RSS (Linux)")
+    parser.add_argument("--json", help="also write the summaries to this file")
+    args = parser.parse_args()
+
+    async def run_all():
+        generator = LoadGenerator(args.url, args.model, args.steps)
+        summaries = {}
+        for scenario in args.scenario or SCENARIOS:
+            generating = scenario.startswith("generate")
+            result = await generator.run(scenario, args.concurrency,
+                                         duration=None if generating else args.duration,
+                                         requests=args.generate_requests if generating else None,
+                                         server_pid=args.server_pid)
+            summaries[scenario] = result.summary()
+        return summaries
+
+    summaries = asyncio.run(run_all())
+    print(format_report(summaries))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"scenarios": summaries}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
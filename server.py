@@ -4,19 +4,62 @@ Simple proxy server for Ollama Image Generator
 Serves the HTML interface and forwards API requests to Ollama
 """
 
+from http import HTTPStatus
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import http.client
 import json
-import urllib.request
-import urllib.error
 from pathlib import Path
-from datetime import datetime
-import base64
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+import binascii
+import bisect
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import os
 import re
+import argparse
+import asyncio
+import math
+import queue
+import select
+import shutil
+import sqlite3
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    from PIL import Image  # Optional: faster thumbnails and WebP output
+except ImportError:
+    Image = None
+
+try:
+    import brotli  # Optional: brotli-compressed pages and JSON for clients that accept it
+except ImportError:
+    brotli = None
 
 OLLAMA_API_URL = "http://localhost:11434/api"
+OLLAMA_BACKEND_URLS = [OLLAMA_API_URL]  # Ollama servers generations are spread across, one per GPU box (see --ollama-url)
 OLLAMA_LOG_LOCATION = "~/.ollama/logs/server.log" # Location of Ollama Log on MacOS - change for Windows and Linux if different!
+OLLAMA_CONNECT_TIMEOUT = 5.0  # Seconds to wait for a TCP connection to Ollama
+OLLAMA_READ_TIMEOUT = 600.0  # Seconds to wait for data from Ollama (model loads can be slow)
+OLLAMA_POOL_SIZE = 8  # Idle keep-alive connections to Ollama kept for reuse
+OLLAMA_POOL_IDLE_TIMEOUT = 30.0  # Seconds before an idle pooled connection is discarded
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes read from Ollama's streamed response at a time
 PORT = 8080
+SERVER_MODE = "threading"  # "threading" (a thread per connection) or "asyncio" (see --server)
+ASYNC_WORKER_THREADS = 8  # In asyncio mode, threads serving the short, non-streaming routes
 IMAGE_GEN_MODEL_LIST = [
     "x/z-image-turbo:bf16",
     "x/z-image-turbo:fp8",
@@ -27,105 +70,3600 @@ IMAGE_GEN_MODEL_LIST = [
 ]
 HISTORY_DIR = Path(__file__).parent / "history"
 HISTORY_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+HISTORY_SHARD_PATTERN = re.compile(r"(\d{4})(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])")  # Date at the start of an id
 LOG_MESSAGE_PATTERN = r'msg="([^"]*)"'
+LOG_READ_BLOCK_SIZE = 64 * 1024  # Bytes read at a time when searching the Ollama log backwards
+LOG_FORWARD_SCAN_LIMIT = 8 * 1024 * 1024  # Larger log growth between lookups is searched backwards instead
+LOG_FINGERPRINT_SIZE = 4096  # Leading bytes of the Ollama log hashed to notice it being rewritten in place
+STATIC_CACHE_CONTROL = "no-cache"  # Pages are revalidated with their ETag on every load, and a 304 costs almost nothing
+COMPRESS_MIN_BYTES = 1024  # Smaller responses are sent uncompressed
+COMPRESS_GZIP_LEVEL = 6  # For JSON responses; static pages are compressed once, at the highest level
+COMPRESS_BROTLI_QUALITY = 5
+HISTORY_IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"  # History ids are never reused for different images
+THUMBNAIL_DIR = HISTORY_DIR / ".thumbs"
+THUMBNAIL_SIZES = (128, 256, 512)  # Allowed thumbnail sizes (longest edge, in pixels)
+THUMBNAIL_DEFAULT_SIZE = 256
+THUMBNAIL_WAIT = 0.5  # Seconds a thumbnail request waits for one being made before getting a placeholder
+HISTORY_RESCAN_INTERVAL = 2.0  # Seconds between checks for changes made to HISTORY_DIR outside the server
+HISTORY_DB_PATH = HISTORY_DIR / "history.db"  # Searchable copy of the history metadata
+HISTORY_SEARCH_DEFAULT_LIMIT = 50
+HISTORY_SEARCH_MAX_LIMIT = 200
+HISTORY_SEARCH_COUNT_LIMIT = 1000  # Search totals are counted up to this many matches and reported as capped beyond
+HISTORY_ARCHIVE_TYPES = {"zip": "application/zip", "tar": "application/x-tar"}  # /history/export formats
+HISTORY_IMPORT_BATCH = 500  # Imported items added to the history database per transaction
+HISTORY_WRITE_QUEUE_SIZE = 32  # Finished images waiting to be written; when full, generations wait for the disk
+HISTORY_WRITE_BATCH = 16  # Most queued images written (and fsynced) together
+HISTORY_WRITE_WAIT = 30.0  # Seconds a request for a just-generated item waits for it to be written
+HISTORY_WRITE_FAILURES_KEPT = 256  # Ids whose write failed, remembered so whoever waits on them can report it
+HISTORY_MAX_ITEMS = None  # Keep at most this many history items, deleting the oldest (see --history-max-items)
+HISTORY_MAX_BYTES = None  # ...and at most this many bytes of images and metadata (see --history-max-size)
+HISTORY_MAX_AGE_DAYS = None  # ...and nothing older than this many days (see --history-max-age)
+HISTORY_RETENTION_INTERVAL = 300.0  # Seconds between retention checks while nothing new is being saved
+MAX_CONCURRENT_GENERATIONS = 1  # Generations sent to each Ollama backend at the same time
+MAX_CONCURRENT_PER_MODEL = 1  # ...and per model (both are multiplied by the number of backends)
+MAX_QUEUED_GENERATIONS = 16  # Waiting generations beyond this are rejected with 429
+RESULT_CACHE_MAX_ENTRIES = 1000  # Seeded generations remembered for instant replay (least recently used dropped)
+BATCH_MAX_JOBS = 64  # Largest sweep /generate/batch will expand
+BATCH_SWEEP_KEYS = ("prompt", "seed", "steps", "width", "height")  # Settings a batch may vary (not the model)
+JOB_RING_SIZE = 256  # Progress lines kept per /jobs generation for subscribers that join or resume late
+JOB_RETENTION = 900.0  # Seconds a finished job can still be looked up and streamed
+JOB_KEEPALIVE_INTERVAL = 15.0  # Seconds between comments on an idle server-sent events stream
+JOB_PATH_PATTERN = re.compile(r"/jobs/([0-9a-f]+)(/stream)?")
+QUEUE_POSITION_INTERVAL = 5.0  # Seconds between repeated queue position lines to a waiting client
+SCHEDULING_MODE = "fifo"  # "fifo" runs queued generations in arrival order, "affinity" runs the loaded model's first
+AFFINITY_MAX_WAIT = 120.0  # In affinity mode, a job waiting longer than this (seconds)...
+AFFINITY_MAX_BYPASS = 4  # ...or overtaken this many times is run next regardless of model
+MODELS_CACHE_TTL = 60.0  # Seconds the /models list is reused before asking Ollama again
+MODEL_STATUS_INTERVAL = 15.0  # Seconds between checks of which models Ollama has loaded (/api/ps)
+MODEL_KEEP_ALIVE = "30m"  # How long Ollama keeps a model loaded after a request (None for Ollama's default)
+PRELOAD_MODELS = []  # Models loaded at startup, before anyone asks for them (see --preload)
+PREDICTIVE_WARMING = True  # Load the most requested model while Ollama is idle (see --no-warming)
+WARM_IDLE_SECONDS = 10.0  # Seconds with no generations running or queued before warming a model
+WARM_HISTORY_SIZE = 50  # Recent /generate requests considered when predicting the next model
+WARM_HALF_LIFE = 600.0  # Seconds after which a past request counts half as much towards the prediction
+WARM_RETRY_INTERVAL = 300.0  # Seconds before warming the same model again if it did not stay loaded
+WARM_MIN_DEMAND = 1.0  # Weighted recent requests a model needs to be warmed, so unused models can unload
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds
+METRICS_GENERATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)  # Seconds
+METRICS_RESOLUTION_BUCKETS = (512, 768, 1024, 1536, 2048)  # Longest side in pixels, for the resolution label
+
+
+class Metric:
+    """One counter, gauge or histogram in a MetricsRegistry."""
+
+    def __init__(self, registry, name, kind, help_text, labelnames=(), buckets=None):
+        self._registry = registry
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(float(b) for b in buckets) if buckets else None
+
+    def inc(self, amount=1, labels=()):
+        shard = self._registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def observe(self, value, labels=()):
+        shard = self._registry.shard()
+        key = (self.name, labels)
+        cells = shard.get(key)
+        if cells is None:
+            # One count per bucket (the last is +Inf), then the running sum
+            cells = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms served in Prometheus text format by
+    GET /metrics. Each thread records into its own shard (a plain dict only
+    that thread writes), so recording never takes a lock or waits on another
+    stream. Shards are summed when /metrics is read, and the shards of
+    finished threads are folded into a shared total so they do not pile up.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._functions = []  # (Metric, callable) pairs sampled at render time
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) pairs
+        self._retired = {}
+        self._lock = threading.Lock()  # Taken once per thread, and by render(); never while recording
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Metric(self, name, "counter", help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Metric(self, name, "gauge", help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        return self._register(Metric(self, name, "histogram", help_text, labelnames, buckets))
+
+    def gauge_function(self, name, help_text, function, kind="gauge"):
+        """A metric whose value is read from function() each time /metrics is served."""
+        self._functions.append((self._register(Metric(self, name, kind, help_text)), function))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def shard(self):
+        """This thread's shard, created the first time the thread records anything."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_finished_threads()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _fold_finished_threads(self):
+        """Merge the shards of threads that have exited into _retired (caller holds the lock)."""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    @staticmethod
+    def _merge(totals, shard):
+        # dict.copy() and list() are atomic, so a shard can be read while its thread writes to it
+        for key, value in shard.copy().items():
+            if isinstance(value, list):
+                value = list(value)
+                current = totals.get(key)
+                totals[key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def render(self):
+        """Return every metric in Prometheus text exposition format."""
+        with self._lock:
+            self._fold_finished_threads()
+            totals = {}
+            self._merge(totals, self._retired)
+            for _, shard in self._shards:
+                self._merge(totals, shard)
+        for metric, function in self._functions:
+            try:
+                totals[(metric.name, ())] = function()
+            except Exception as e:
+                print(f"Error reading metric {metric.name}: {e}", flush=True)
+
+        samples = {}
+        for (name, labels), value in totals.items():
+            samples.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in sorted(samples.get(metric.name, ())):
+                pairs = list(zip(metric.labelnames, labels))
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{format_metric_labels(pairs)} {format_metric_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (math.inf,), value):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else format_metric_value(bound)
+                    lines.append(f"{metric.name}_bucket{format_metric_labels(pairs + [('le', le)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{format_metric_labels(pairs)} {format_metric_value(value[-1])}")
+                lines.append(f"{metric.name}_count{format_metric_labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def metric_model_label(model):
+    """
+    The model label for a generation metric. Requests name any model they
+    like, so only IMAGE_GEN_MODEL_LIST models get their own series and the
+    rest share "other", keeping the number of series bounded.
+    """
+    return model if model in IMAGE_GEN_MODEL_LIST else "other"
+
+
+def metric_resolution_label(width, height):
+    """The resolution label for a generation: the smallest METRICS_RESOLUTION_BUCKETS bound its longest side fits."""
+    try:
+        longest = max(int(width), int(height))
+    except (TypeError, ValueError):
+        return "unknown"
+    for bound in METRICS_RESOLUTION_BUCKETS:
+        if longest <= bound:
+            return f"<={bound}px"
+    return f">{METRICS_RESOLUTION_BUCKETS[-1]}px"
+
+
+def format_metric_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_metric_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+METRICS = MetricsRegistry()
+METRIC_QUEUE_WAIT = METRICS.histogram(
+    "ollama_proxy_queue_wait_seconds", "Time /generate requests waited for a generation slot.",
+    ("model",), METRICS_GENERATION_BUCKETS)
+METRIC_UPSTREAM_CONNECT = METRICS.histogram(
+    "ollama_proxy_upstream_connect_seconds", "Time to open a new TCP connection to Ollama.")
+METRIC_UPSTREAM_REQUESTS = METRICS.counter(
+    "ollama_proxy_upstream_requests_total", "Requests sent to Ollama, by whether a pooled connection was reused.",
+    ("reused",))
+METRIC_FIRST_PROGRESS = METRICS.histogram(
+    "ollama_proxy_generate_first_progress_seconds",
+    "Time from sending a generation to Ollama until its first progress line arrived.",
+    ("model",), METRICS_GENERATION_BUCKETS)
+METRIC_GENERATION_DURATION = METRICS.histogram(
+    "ollama_proxy_generation_duration_seconds", "Time from a generation starting until Ollama finished it.",
+    ("model", "resolution"), METRICS_GENERATION_BUCKETS)
+METRIC_GENERATIONS = METRICS.counter(
+    "ollama_proxy_generations_total", "/generate requests by outcome.", ("model", "outcome"))
+METRIC_STREAM_BYTES = METRICS.counter(
+    "ollama_proxy_stream_bytes_total", "Bytes of /generate responses streamed to clients.", ("model",))
+METRIC_ACTIVE_STREAMS = METRICS.gauge(
+    "ollama_proxy_active_streams", "Generations currently streaming from Ollama to a client.")
+METRIC_INDEX_SCAN = METRICS.histogram(
+    "ollama_proxy_history_index_scan_seconds", "Time to scan HISTORY_DIR when building or refreshing the index.")
+METRIC_INDEX_READ = METRICS.histogram(
+    "ollama_proxy_history_index_read_seconds", "Time to read a page of the history index.")
+METRIC_HISTORY_SEARCH = METRICS.histogram(
+    "ollama_proxy_history_search_seconds", "Time to run a /history/search query.")
+METRIC_HISTORY_WRITE = METRICS.histogram(
+    "ollama_proxy_history_write_seconds", "Time to write a batch of history items to disk.")
+METRIC_HISTORY_EVICTIONS = METRICS.counter(
+    "ollama_proxy_history_evictions_total", "History items deleted by the retention limits.")
+METRIC_LOG_LOOKUP = METRICS.histogram(
+    "ollama_proxy_log_lookup_seconds", "Time to find the latest Ollama log message.", ("level",))
+METRIC_MODEL_WARMUPS = METRICS.counter(
+    "ollama_proxy_model_warmups_total", "Models loaded ahead of demand, by reason and outcome.",
+    ("model", "reason", "outcome"))
+METRIC_BACKEND_REQUESTS = METRICS.counter(
+    "ollama_proxy_backend_requests_total", "Requests sent to each Ollama backend, by outcome.",
+    ("backend", "outcome"))
+METRIC_BACKEND_IN_FLIGHT = METRICS.gauge(
+    "ollama_proxy_backend_in_flight", "Requests each Ollama backend is working on.", ("backend",))
+METRIC_BACKEND_LATENCY = METRICS.histogram(
+    "ollama_proxy_backend_response_seconds", "Time for each Ollama backend to start answering.", ("backend",))
+
+
+class OllamaHTTPError(Exception):
+    """Ollama answered with an HTTP error status."""
+
+    def __init__(self, code, reason, headers, body):
+        super().__init__(f"HTTP {code}: {reason}")
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class OllamaConnectionError(Exception):
+    """Ollama could not be reached, or dropped the connection."""
+
+
+class OllamaConnectError(OllamaConnectionError):
+    """No connection to Ollama could be made, so it never saw the request."""
+
+
+class PooledResponse:
+    """
+    A response from Ollama on a pooled connection. The connection goes back
+    to the pool once the body has been read to the end, otherwise it is closed.
+    """
+
+    def __init__(self, pool, connection, response):
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.on_close = None  # Called once, when the response is closed
+
+    def read(self):
+        return self._response.read()
+
+    def iter_chunks(self, size=STREAM_CHUNK_SIZE):
+        """Yield the body in chunks of up to size bytes as they arrive."""
+        while True:
+            chunk = self._response.read1(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self._connection is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        if reusable:
+            self._pool.release(self._connection)
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
+        if self.on_close is not None:
+            self.on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OllamaConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections to the Ollama API.
+    Idle sockets are checked before reuse, and a request that fails on a
+    reused socket the server has already closed is retried once on a new one.
+    """
+
+    def __init__(self, base_url, max_idle=OLLAMA_POOL_SIZE, idle_timeout=OLLAMA_POOL_IDLE_TIMEOUT,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT):
+        parts = urlsplit(base_url)
+        self.base_url = base_url
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """Return (connection, reused), preferring the most recently used idle connection."""
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if now - last_used < self.idle_timeout and self._is_alive(connection):
+                return connection, True
+            connection.close()
+
+        connection = self._connection_class(self.host, self.port, timeout=self.connect_timeout)
+        started = time.monotonic()
+        try:
+            connection.connect()
+        except OSError as e:
+            connection.close()
+            raise OllamaConnectError(f"{e} ({self.base_url})") from e
+        METRIC_UPSTREAM_CONNECT.observe(time.monotonic() - started)
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    @staticmethod
+    def _is_alive(connection):
+        """An idle keep-alive socket that is readable has been closed (or is sending junk)."""
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request to Ollama and return a PooledResponse.
+        Raises OllamaHTTPError for error statuses and OllamaConnectionError
+        if Ollama cannot be reached.
+        """
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "application/json")
+        while True:
+            connection, reused = self._acquire()
+            METRIC_UPSTREAM_REQUESTS.inc(labels=("true" if reused else "false",))
+            try:
+                connection.request(method, self.base_path + path, body=body, headers=headers)
+                response = connection.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                if reused:
+                    continue  # Stale keep-alive socket; the server never saw the request
+                raise OllamaConnectionError(f"connection closed: {e}") from e
+            except OSError as e:
+                connection.close()
+                raise OllamaConnectionError(str(e)) from e
+
+        pooled = PooledResponse(self, connection, response)
+        if response.status >= 400:
+            with pooled:
+                error_body = pooled.read()
+            raise OllamaHTTPError(response.status, response.reason, response.headers, error_body)
+        return pooled
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+class OllamaBackend:
+    """
+    One Ollama server: its connection pool, whether it is answering, the
+    models it has installed and loaded, and its request statistics.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.pool = OllamaConnectionPool(base_url)
+        self._lock = threading.Lock()
+        self.healthy = True  # Until a request or health check cannot connect
+        self.error = None  # Why the last attempt failed, until one succeeds
+        self.models = None  # Installed model names (/api/tags), None until checked
+        self.loaded = set()  # Loaded model names (/api/ps)
+        self.checked_at = None  # Monotonic time of the last successful health check
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.average_latency = None  # Seconds to the response headers, moving average
+
+    def begin(self):
+        """Count a request as in flight; returns its start time for settle()."""
+        with self._lock:
+            self.in_flight += 1
+        METRIC_BACKEND_IN_FLIGHT.inc(labels=(self.base_url,))
+        return time.monotonic()
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+        METRIC_BACKEND_IN_FLIGHT.dec(labels=(self.base_url,))
+
+    def settle(self, started, error=None, model=None):
+        """Record how the wait for a response ended. A request that failed is no longer in flight."""
+        if error is None or isinstance(error, OllamaHTTPError):
+            latency = time.monotonic() - started
+            METRIC_BACKEND_LATENCY.observe(latency, (self.base_url,))
+            outcome = "ok" if error is None else "http_error"
+            with self._lock:
+                self.healthy = True
+                self.error = None
+                self.average_latency = (latency if self.average_latency is None
+                                        else 0.8 * self.average_latency + 0.2 * latency)
+                if error is None and model:
+                    self.loaded.add(model)
+        elif isinstance(error, OllamaConnectionError):
+            outcome = "connect_error" if isinstance(error, OllamaConnectError) else "error"
+            with self._lock:
+                self.healthy = False
+                self.error = str(error)
+                self.failures += 1
+        else:
+            outcome = "error"
+        with self._lock:
+            self.requests += 1
+        METRIC_BACKEND_REQUESTS.inc(labels=(self.base_url, outcome))
+        if error is not None:
+            self.end()
+
+    def request(self, method, path, body=None, headers=None, model=None):
+        """Send a request on the pool; it stays in flight until the PooledResponse is closed."""
+        started = self.begin()
+        try:
+            response = self.pool.request(method, path, body=body, headers=headers)
+        except BaseException as e:
+            self.settle(started, e)
+            raise
+        self.settle(started, model=model)
+        response.on_close = self.end
+        return response
+
+    async def open_stream(self, method, path, body=b"", model=None):
+        """The asyncio equivalent of request(), returning an AsyncOllamaResponse."""
+        started = self.begin()
+        try:
+            response = await open_backend_stream(self.base_url, method, path, body)
+        except BaseException as e:
+            self.settle(started, e)
+            raise
+        self.settle(started, model=model)
+        response.on_close = self.end
+        return response
+
+    def get_json(self, path):
+        with self.request("GET", path) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def record_check(self, models=None, loaded=None):
+        """Store what a health check found installed (/api/tags) or loaded (/api/ps)."""
+        with self._lock:
+            if models is not None:
+                self.models = set(models)
+            if loaded is not None:
+                self.loaded = set(loaded)
+            self.checked_at = time.monotonic()
+
+    def rank(self, model):
+        """Sort key for sending a request for model here (None for requests not about a model); lower is better."""
+        with self._lock:
+            if model is None:
+                return (not self.healthy, self.in_flight, self.average_latency or 0.0)
+            return (not self.healthy,
+                    self.in_flight >= MAX_CONCURRENT_GENERATIONS,
+                    model not in self.loaded,
+                    self.models is not None and model not in self.models,
+                    self.in_flight,
+                    self.average_latency or 0.0)
+
+    def status(self):
+        with self._lock:
+            return {
+                "url": self.base_url,
+                "healthy": self.healthy,
+                "error": self.error,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "failures": self.failures,
+                "average_latency": None if self.average_latency is None else round(self.average_latency, 3),
+                "models": None if self.models is None else sorted(self.models),
+                "loaded": sorted(self.loaded),
+                "checked_seconds_ago": (round(time.monotonic() - self.checked_at, 1)
+                                        if self.checked_at is not None else None),
+            }
+
+
+class OllamaBackendSet:
+    """
+    The Ollama servers generations are spread across. A request goes to a
+    healthy backend that has its model loaded and a free slot, otherwise to
+    the least loaded one. If a backend cannot be connected to, the request
+    moves on to the next before anything has been sent to the client, so a
+    connection error only reaches the client once every backend has refused.
+    The backends are health-checked by MODEL_RESIDENCY's background polls of
+    /api/tags and /api/ps, and by every request.
+    """
+
+    def __init__(self, base_urls):
+        self.backends = [OllamaBackend(url) for url in base_urls]
+
+    def candidates(self, model=None):
+        """Every backend, the best one for a request for model first."""
+        return sorted(self.backends, key=lambda backend: backend.rank(model))
+
+    def request(self, method, path, body=None, headers=None, model=None):
+        """
+        Send a request to the best backend for model and return its
+        PooledResponse. Raises OllamaHTTPError, or OllamaConnectionError if no
+        backend can be connected to (or one fails after taking the request).
+        """
+        error = None
+        for backend in self.candidates(model):
+            try:
+                return backend.request(method, path, body, headers, model)
+            except OllamaConnectError as e:
+                error = e
+                self.log_failover(backend, e)
+        raise error
+
+    def log_failover(self, backend, error):
+        if len(self.backends) > 1:
+            print(f"⚠️  Ollama backend {backend.base_url} unreachable ({error}); trying the next", flush=True)
+
+    def installed_models(self):
+        """
+        The models installed on any backend (/api/tags merged), in the order
+        first seen. Asks every backend; raises the last error if none answers.
+        """
+        names = []
+        answered = False
+        error = None
+        for backend in self.backends:
+            try:
+                backend_names = [model["name"] for model in backend.get_json("/tags")["models"]]
+            except (OllamaHTTPError, OllamaConnectionError, ValueError, KeyError) as e:
+                error = e
+                continue
+            answered = True
+            backend.record_check(models=backend_names)
+            names.extend(name for name in backend_names if name not in names)
+        if not answered:
+            raise error
+        return names
+
+    def loaded_models(self):
+        """
+        Every backend's loaded models (/api/ps entries, each with its
+        "backend"). Asks every backend; raises the last error if none answers.
+        """
+        entries = []
+        answered = False
+        error = None
+        for backend in self.backends:
+            try:
+                models = backend.get_json("/ps").get("models", [])
+            except (OllamaHTTPError, OllamaConnectionError, ValueError) as e:
+                error = e
+                continue
+            answered = True
+            backend.record_check(loaded=[model.get("name") for model in models])
+            entries.extend(dict(model, backend=backend.base_url) for model in models)
+        if not answered:
+            raise error
+        return entries
+
+    def stats(self):
+        return [backend.status() for backend in self.backends]
+
+    def close(self):
+        for backend in self.backends:
+            backend.pool.close()
+
+
+OLLAMA_BACKENDS = OllamaBackendSet(OLLAMA_BACKEND_URLS)
+
+
+class OllamaLogFollower:
+    """
+    Finds the latest Ollama log message for a level without reading the whole log.
+    The first lookup reads the file backwards from the end in blocks until it
+    finds a match; after that a cursor scans only the bytes appended since the
+    previous lookup. A rotated, truncated or hugely grown file starts afresh;
+    a hash of the file's first bytes catches one truncated and then grown
+    past the cursor between lookups.
+    """
+
+    LINE_PATTERN = re.compile(rb'level=(\w+)[^\n]*?' + LOG_MESSAGE_PATTERN.encode())
+
+    def __init__(self, log_location):
+        self.log_location = log_location
+        self._lock = threading.Lock()
+        self._identity = None
+        self._fingerprint = None  # (length, sha1) of the file's first LOG_FINGERPRINT_SIZE bytes
+        self._offset = 0  # End of the last complete line scanned
+        self._latest = {}  # level -> latest message (None if the file has none)
+
+    def latest(self, level):
+        log_path = Path(self.log_location).expanduser()
+        try:
+            stat = log_path.stat()
+        except OSError:
+            return None
+
+        with self._lock:
+            try:
+                with open(log_path, "rb") as f:
+                    identity = (stat.st_dev, stat.st_ino)
+                    if (identity != self._identity or stat.st_size < self._offset
+                            or stat.st_size - self._offset > LOG_FORWARD_SCAN_LIMIT
+                            or self._read_fingerprint(f, self._fingerprint[0]) != self._fingerprint):
+                        self._reset(f, identity, stat.st_size)
+                    elif stat.st_size > self._offset:
+                        self._scan_forward(f, stat.st_size)
+                        if self._fingerprint[0] < LOG_FINGERPRINT_SIZE:
+                            self._fingerprint = self._read_fingerprint(f, LOG_FINGERPRINT_SIZE)
+
+                    if level not in self._latest:
+                        self._latest[level] = self._search_backward(f, level, self._offset)
+            except OSError:
+                return None
+            return self._latest[level]
+
+    def _reset(self, f, identity, size):
+        """Start following a new file: the cursor goes to the end of its last complete line."""
+        self._identity = identity
+        self._fingerprint = self._read_fingerprint(f, LOG_FINGERPRINT_SIZE)
+        self._latest = {}
+        f.seek(max(size - LOG_READ_BLOCK_SIZE, 0))
+        tail = f.read(size - f.tell())
+        self._offset = size - len(tail) + tail.rfind(b"\n") + 1
+
+    @staticmethod
+    def _read_fingerprint(f, length):
+        """(length, sha1) of up to length bytes from the start of the file."""
+        f.seek(0)
+        head = f.read(length)
+        return len(head), hashlib.sha1(head).hexdigest()
+
+    def _scan_forward(self, f, size):
+        """Scan complete lines appended since the last lookup."""
+        f.seek(self._offset)
+        data = f.read(size - self._offset)
+        end = data.rfind(b"\n") + 1
+        for match in self.LINE_PATTERN.finditer(data, 0, end):
+            self._latest[match.group(1).decode("ascii")] = match.group(2).decode("utf-8", errors="replace")
+        self._offset += end
+
+    def _search_backward(self, f, level, limit):
+        """Return the last message for level before offset limit, reading backwards in blocks."""
+        pattern = re.compile(rb'level=' + re.escape(level.encode()) + rb'[^\n]*?' + LOG_MESSAGE_PATTERN.encode())
+        position = limit
+        carry = b""
+        while position > 0:
+            start = max(position - LOG_READ_BLOCK_SIZE, 0)
+            f.seek(start)
+            block = f.read(position - start) + carry
+            position = start
+            # The text before the first newline may continue in the previous block
+            cut = block.find(b"\n") + 1 if position > 0 else 0
+            carry = block[:cut]
+            match = None
+            for match in pattern.finditer(block, cut):
+                pass
+            if match:
+                return match.group(1).decode("utf-8", errors="replace")
+        return None
+
+
+LOG_FOLLOWER = OllamaLogFollower(OLLAMA_LOG_LOCATION)
+
+
+def get_latest_log_message(level):
+    """Return the latest log message for a given level, or None if not found."""
+    started = time.monotonic()
+    try:
+        return LOG_FOLLOWER.latest(level)
+    finally:
+        METRIC_LOG_LOOKUP.observe(time.monotonic() - started, (level,))
+
+
+def ensure_history_dir():
+    """Ensure the history directory exists"""
+    HISTORY_DIR.mkdir(exist_ok=True)
+
+
+def load_history_metadata(json_file):
+    """Load a history metadata file, dropping any embedded image data."""
+    with open(json_file, 'r') as f:
+        item_data = json.load(f)
+    item_data.pop("image", None)
+    return item_data
+
+
+def new_history_id(now=None):
+    """
+    A unique, time-ordered history id: the local time to the second (as ids
+    have always started), then microseconds and a random byte so items made
+    in the same second, by this or another server process, never collide.
+    """
+    now = now or datetime.now()
+    return f"{now:%Y%m%d%H%M%S}-{now:%f}{os.urandom(1).hex()}"
+
+
+def history_shard(image_name):
+    """The YYYY/MM/DD directory (relative to HISTORY_DIR) for an id, or None if it has no date."""
+    match = HISTORY_SHARD_PATTERN.match(image_name)
+    return Path(*match.groups()) if match else None
+
+
+def iter_history_dirs(history_dir):
+    """
+    Yield every directory that can hold history items, as strings: the top
+    level (the old flat layout) first, then each YYYY/MM/DD shard, oldest first.
+    """
+    history_dir = str(history_dir)
+    yield history_dir
+
+    def subdirectories(path, width):
+        try:
+            with os.scandir(path) as entries:
+                names = [entry.name for entry in entries
+                         if len(entry.name) == width and entry.name.isdigit() and entry.is_dir()]
+        except FileNotFoundError:
+            return []
+        return [os.path.join(path, name) for name in sorted(names)]
+
+    for year_dir in subdirectories(history_dir, 4):
+        for month_dir in subdirectories(year_dir, 2):
+            yield from subdirectories(month_dir, 2)
+
+
+def iter_history_files(history_dir, suffix):
+    """Yield the Path of every history file with suffix (".json" or ".png"), shard by shard."""
+    for shard_dir in iter_history_dirs(history_dir):
+        try:
+            with os.scandir(shard_dir) as entries:
+                names = [entry.name for entry in entries if entry.name.endswith(suffix) and entry.is_file()]
+        except FileNotFoundError:
+            continue
+        for name in names:
+            yield Path(shard_dir, name)
+
+
+# Held while history files are moved or deleted, so a migration never races a delete
+HISTORY_FILES_LOCK = threading.Lock()
+
+
+def migrate_flat_history():
+    """
+    Move items (and thumbnails) from the old flat HISTORY_DIR layout into
+    YYYY/MM/DD shards; returns (moved, left). Safe while the server runs:
+    each file is renamed atomically, the image before its metadata, and
+    resolve_history_path falls back to the flat path until an item has moved.
+    Ids without a date stay where they are.
+    """
+    moved = left = 0
+    with os.scandir(HISTORY_DIR) as entries:
+        image_names = [entry.name[:-5] for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+    for image_name in image_names:
+        shard = history_shard(image_name)
+        if shard is None or not HISTORY_ID_PATTERN.fullmatch(image_name):
+            left += 1
+            continue
+        shard_dir = HISTORY_DIR / shard
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        with HISTORY_FILES_LOCK:
+            for suffix in (".png", ".json"):
+                try:
+                    os.replace(HISTORY_DIR / f"{image_name}{suffix}", shard_dir / f"{image_name}{suffix}")
+                except FileNotFoundError:
+                    pass
+        moved += 1
+
+    if THUMBNAIL_DIR.is_dir():
+        with os.scandir(THUMBNAIL_DIR) as entries:
+            thumb_names = [entry.name for entry in entries if entry.is_file() and not entry.name.startswith(".")]
+        for thumb_name in thumb_names:
+            shard = history_shard(thumb_name.rsplit("-", 1)[0])
+            if shard is not None:
+                (THUMBNAIL_DIR / shard).mkdir(parents=True, exist_ok=True)
+                try:
+                    os.replace(THUMBNAIL_DIR / thumb_name, THUMBNAIL_DIR / shard / thumb_name)
+                except FileNotFoundError:
+                    pass
+    return moved, left
+
+
+def has_flat_history():
+    """True if HISTORY_DIR still holds items in the old flat layout that can be sharded."""
+    try:
+        with os.scandir(HISTORY_DIR) as entries:
+            return any(entry.name.endswith(".json") and history_shard(entry.name) for entry in entries)
+    except FileNotFoundError:
+        return False
+
+
+class HistoryIndex:
+    """
+    In-memory index of history metadata, newest first.
+    Built once at startup, updated in place when the server saves or deletes
+    an item, and rescanned when HISTORY_DIR is changed by something else.
+    Scans go shard directory by shard directory, and a shard whose mtime has
+    not changed since its last scan is skipped without being listed.
+    """
+
+    def __init__(self, history_dir):
+        self.history_dir = history_dir
+        self._lock = threading.RLock()
+        self._items = {}
+        self._order = []  # ids sorted oldest first so new items append cheaply
+        self._file_mtimes = {}
+        self._shard_mtimes = {}  # shard directory -> mtime when it was last listed
+        self._shard_items = {}  # shard directory -> ids found there
+        self._item_shards = {}  # id -> shard directory
+        self._checked_at = 0.0
+        self._version = 0
+        self._instance = format(int(time.time() * 1000), "x")
+
+    @property
+    def etag(self):
+        return f'"{self._instance}-{self._version}"'
+
+    def build(self):
+        """Scan HISTORY_DIR and return the number of indexed items."""
+        with self._lock:
+            self._rescan()
+            return len(self._order)
+
+    def refresh_if_stale(self):
+        """Rescan shards that changed since the last check (rate limited)."""
+        now = time.monotonic()
+        if now - self._checked_at < HISTORY_RESCAN_INTERVAL:
+            return
+        with self._lock:
+            self._rescan()
+
+    def _rescan(self):
+        """Bring the index in line with the directory, listing only shards that changed."""
+        started = time.monotonic()
+        ensure_history_dir()
+        self._checked_at = time.monotonic()
+        changed = False
+        present = set()
+        for shard_dir in iter_history_dirs(self.history_dir):
+            present.add(shard_dir)
+            try:
+                mtime = os.stat(shard_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._shard_mtimes.get(shard_dir) != mtime:
+                changed |= self._rescan_shard(shard_dir)
+                self._shard_mtimes[shard_dir] = mtime
+        for shard_dir in [d for d in self._shard_mtimes if d not in present]:
+            changed |= self._rescan_shard(shard_dir)
+            del self._shard_mtimes[shard_dir]
+
+        if changed:
+            self._version += 1
+        METRIC_INDEX_SCAN.observe(time.monotonic() - started)
+
+    def _rescan_shard(self, shard_dir):
+        """List one shard directory, loading only new or changed files; returns True if anything changed."""
+        seen = {}
+        try:
+            with os.scandir(shard_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        try:
+                            seen[entry.name[:-5]] = (entry.path, entry.stat().st_mtime_ns)
+                        except FileNotFoundError:
+                            continue
+        except FileNotFoundError:
+            pass
+
+        changed = False
+        for image_name in self._shard_items.get(shard_dir, set()) - seen.keys():
+            changed |= self._discard(image_name)
+
+        for image_name, (json_file, mtime) in seen.items():
+            # Track where each item lives, so one moving between shards is not lost
+            previous_shard = self._item_shards.get(image_name)
+            if previous_shard != shard_dir:
+                if previous_shard is not None:
+                    self._shard_items[previous_shard].discard(image_name)
+                self._item_shards[image_name] = shard_dir
+                self._shard_items.setdefault(shard_dir, set()).add(image_name)
+            if self._file_mtimes.get(image_name) == mtime:
+                continue
+            try:
+                item_data = load_history_metadata(json_file)
+            except Exception as e:
+                print(f"Error reading {json_file}: {e}")
+                continue
+            self._store(image_name, item_data)
+            self._file_mtimes[image_name] = mtime
+            changed = True
+
+        if not self._shard_items.get(shard_dir, True):
+            del self._shard_items[shard_dir]
+        return changed
+
+    def _store(self, image_name, item_data):
+        if image_name not in self._items:
+            bisect.insort(self._order, image_name)
+        self._items[image_name] = item_data
+
+    def _discard(self, image_name):
+        shard_dir = self._item_shards.pop(image_name, None)
+        if shard_dir is not None:
+            self._shard_items[shard_dir].discard(image_name)
+        if self._items.pop(image_name, None) is None:
+            return False
+        del self._order[bisect.bisect_left(self._order, image_name)]
+        self._file_mtimes.pop(image_name, None)
+        return True
+
+    def add(self, image_name, item_data):
+        """Record an item the server has just written to disk."""
+        with self._lock:
+            self._store(image_name, {k: v for k, v in item_data.items() if k != "image"})
+            self._file_mtimes.pop(image_name, None)
+            self._version += 1
+
+    def remove(self, image_name):
+        """Forget an item the server has just deleted from disk."""
+        self.remove_many([image_name])
+
+    def remove_many(self, image_names):
+        """Forget items the server has just deleted from disk, as a single change to the index."""
+        with self._lock:
+            removed = [image_name for image_name in image_names if self._discard(image_name)]
+            if removed:
+                self._version += 1
+
+    def page(self, offset=0, limit=None):
+        """Return (items, total, etag) for a newest-first slice of the index."""
+        started = time.monotonic()
+        with self._lock:
+            total = len(self._order)
+            end = total - offset
+            start = 0 if limit is None else max(end - limit, 0)
+            ids = self._order[start:max(end, 0)]
+            items = [self._items[image_name] for image_name in reversed(ids)]
+            etag = self.etag
+        METRIC_INDEX_READ.observe(time.monotonic() - started)
+        return items, total, etag
+
+
+HISTORY_INDEX = HistoryIndex(HISTORY_DIR)
+
+
+class HistoryStore:
+    """
+    SQLite copy of the history metadata, kept next to the PNGs, for finding
+    images by prompt text, model, size or date without reading every JSON
+    file. The JSON files remain the record; the store is updated alongside
+    them and can be rebuilt from them at any time. Uses WAL mode so searches
+    never wait for a save, and an FTS5 index on prompts where SQLite has it
+    (otherwise prompt search falls back to LIKE).
+    """
+
+    COLUMNS = ("id", "created", "model", "prompt", "seed", "width", "height", "steps", "metadata")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.fts = None  # Known once the schema is created
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+
+    def _connection(self):
+        """This thread's connection, creating the database on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            ensure_history_dir()
+            connection = sqlite3.connect(self.db_path, timeout=10)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if self.fts is None:
+                    self._create_schema(connection)
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self, connection):
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id TEXT PRIMARY KEY,
+                    created TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    seed INTEGER,
+                    width INTEGER,
+                    height INTEGER,
+                    steps INTEGER,
+                    metadata TEXT NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS history_model ON history (model, id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS history_size ON history (width, height, id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS history_created ON history (created)")
+        try:
+            with connection:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                                   "prompt, content='history', content_rowid='rowid')")
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                        INSERT INTO history_fts (rowid, prompt) VALUES (new.rowid, new.prompt);
+                    END""")
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                        INSERT INTO history_fts (history_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+                    END""")
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS history_fts_update AFTER UPDATE ON history BEGIN
+                        INSERT INTO history_fts (history_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+                        INSERT INTO history_fts (rowid, prompt) VALUES (new.rowid, new.prompt);
+                    END""")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"SQLite full-text search unavailable ({e}); prompt search will be slower", flush=True)
+            self.fts = False
+
+    @staticmethod
+    def _row(item_data):
+        settings = item_data.get("settings", {})
+        return (item_data["id"], item_data.get("timestamp", ""), settings.get("model", ""),
+                settings.get("prompt", ""), settings.get("seed"), settings.get("width"),
+                settings.get("height"), settings.get("steps"),
+                json.dumps({k: v for k, v in item_data.items() if k != "image"}))
+
+    def add_many(self, items):
+        """Insert or update history items (metadata dicts, as saved in the JSON files)."""
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.COLUMNS[1:])
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                f"INSERT INTO history ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))}) "
+                f"ON CONFLICT (id) DO UPDATE SET {updates}",
+                (self._row(item_data) for item_data in items if item_data.get("id")))
+
+    def add(self, item_data):
+        self.add_many([item_data])
+
+    def remove_many(self, image_names):
+        connection = self._connection()
+        with connection:
+            connection.executemany("DELETE FROM history WHERE id = ?", ((name,) for name in image_names))
+
+    def remove(self, image_name):
+        self.remove_many([image_name])
+
+    def ids(self):
+        return {row[0] for row in self._connection().execute("SELECT id FROM history")}
+
+    def sync(self, items):
+        """Make the store match items (e.g. the history index); returns (added, removed)."""
+        items = {item_data["id"]: item_data for item_data in items if item_data.get("id")}
+        stored = self.ids()
+        stale = stored - items.keys()
+        missing = [item_data for image_name, item_data in items.items() if image_name not in stored]
+        self.remove_many(stale)
+        self.add_many(missing)
+        return len(missing), len(stale)
+
+    def import_files(self, history_dir, batch_size=1000):
+        """Load every *.json file in history_dir into the store; returns (imported, removed, failed)."""
+        found = set()
+        batch = []
+        imported = failed = 0
+        for json_file in iter_history_files(history_dir, ".json"):
+            try:
+                item_data = load_history_metadata(json_file)
+                item_data.setdefault("id", json_file.stem)
+            except Exception as e:
+                print(f"Error reading {json_file}: {e}")
+                failed += 1
+                continue
+            found.add(item_data["id"])
+            batch.append(item_data)
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                imported += len(batch)
+                batch = []
+        self.add_many(batch)
+        imported += len(batch)
+        stale = self.ids() - found
+        self.remove_many(stale)
+        return imported, len(stale), failed
+
+    def search(self, text="", model=None, width=None, height=None, created_from=None, created_to=None,
+               before=None, offset=0, limit=HISTORY_SEARCH_DEFAULT_LIMIT):
+        """
+        Return (items, total) for history matching every given filter, newest
+        first. text matches whole words in the prompt (the last one as a
+        prefix); created_from/created_to are ISO timestamps, to exclusive.
+        before is the id of the last item of the previous page (keyset paging,
+        which unlike offset costs the same on every page). total counts at
+        most HISTORY_SEARCH_COUNT_LIMIT matches, ignoring before and offset.
+        """
+        started = time.monotonic()
+        connection = self._connection()
+        conditions = []
+        params = []
+        words = text.split()
+        if words and self.fts:
+            # Quote every word so FTS5 query syntax in the text is taken literally
+            phrase = " ".join('"' + word.replace('"', '""') + '"' for word in words) + "*"
+            # A subquery rather than a join, so the planner runs the full-text match once
+            conditions.append("rowid IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append(phrase)
+        else:
+            for word in words:
+                conditions.append("prompt LIKE ? ESCAPE '\\'")
+                params.append("%" + re.sub(r"([%_\\])", r"\\\1", word) + "%")
+        for column, value in (("model", model), ("width", width), ("height", height)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if created_from:
+            conditions.append("created >= ?")
+            params.append(created_from)
+        if created_to:
+            conditions.append("created < ?")
+            params.append(created_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        if words and self.fts and len(conditions) == 1:
+            total = connection.execute("SELECT COUNT(*) FROM (SELECT 1 FROM history_fts WHERE history_fts MATCH ? "
+                                       "LIMIT ?)", params + [HISTORY_SEARCH_COUNT_LIMIT])
+        else:
+            total = connection.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM history {where} LIMIT ?)",
+                                       params + [HISTORY_SEARCH_COUNT_LIMIT])
+        total = total.fetchone()[0]
+        if not total:
+            METRIC_HISTORY_SEARCH.observe(time.monotonic() - started)
+            return [], 0
+
+        if words and self.fts and total >= HISTORY_SEARCH_COUNT_LIMIT:
+            # Many matches: walk the id index newest first until a page is found rather than sorting them
+            # all ("+rowid" stops SQLite looking the matches up by rowid, which would need the sort)
+            conditions[0] = "+" + conditions[0]
+        if before:
+            conditions.append("id < ?")
+            params.append(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # Order just the matching ids, then fetch the metadata for one page of them
+        rows = connection.execute(f"SELECT metadata FROM history WHERE rowid IN "
+                                  f"(SELECT rowid FROM history {where} ORDER BY id DESC LIMIT ? OFFSET ?) "
+                                  f"ORDER BY id DESC", params + [limit, offset])
+        items = [json.loads(metadata) for (metadata,) in rows]
+        METRIC_HISTORY_SEARCH.observe(time.monotonic() - started)
+        return items, total
+
+
+HISTORY_STORE = HistoryStore(HISTORY_DB_PATH)
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}  # PNG colour type -> samples per pixel
+
+
+def png_dimensions(header):
+    """Return (width, height) from the first 24 bytes of a PNG; IHDR is always its first chunk."""
+    if not header.startswith(PNG_SIGNATURE) or header[12:16] != b"IHDR":
+        raise ValueError("Not a PNG file")
+    return struct.unpack(">II", header[16:24])
+
+
+def decode_png(data):
+    """
+    Decode an 8-bit, non-interlaced PNG using only the standard library.
+    Returns (width, height, channels, rows) where rows is a list of bytes per scanline.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file")
+
+    pos = len(PNG_SIGNATURE)
+    header = None
+    idat = []
+    while pos < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"IDAT":
+            idat.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+
+    if header is None:
+        raise ValueError("PNG has no IHDR chunk")
+    width, height, bit_depth, colour_type, _, _, interlace = header
+    if bit_depth != 8 or interlace or colour_type not in PNG_CHANNELS:
+        raise ValueError("Unsupported PNG format for the built-in thumbnailer")
+
+    channels = PNG_CHANNELS[colour_type]
+    stride = width * channels
+    raw = zlib.decompress(b"".join(idat))
+    rows = []
+    previous = bytes(stride)
+    for y in range(height):
+        offset = y * (stride + 1)
+        filter_type = raw[offset]
+        row = bytearray(raw[offset + 1:offset + 1 + stride])
+        if filter_type == 1:  # Sub
+            for i in range(channels, stride):
+                row[i] = (row[i] + row[i - channels]) & 0xFF
+        elif filter_type == 2:  # Up
+            row = bytearray(bytes_add(row, previous))
+        elif filter_type == 3:  # Average
+            for i in range(stride):
+                left = row[i - channels] if i >= channels else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif filter_type == 4:  # Paeth
+            for i in range(stride):
+                a = row[i - channels] if i >= channels else 0
+                b = previous[i]
+                c = previous[i - channels] if i >= channels else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+                row[i] = (row[i] + predictor) & 0xFF
+        previous = bytes(row)
+        rows.append(previous)
+    return width, height, channels, rows
+
+
+def bytes_add(a, b):
+    """Add two equal-length byte strings bytewise modulo 256 (SWAR on Python ints)."""
+    n = len(a)
+    low = int.from_bytes(b"\x7f" * n, "big")
+    high = int.from_bytes(b"\x80" * n, "big")
+    x = int.from_bytes(a, "big")
+    y = int.from_bytes(b, "big")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, "big")
+
+
+def encode_png(width, height, channels, rows):
+    """Encode scanlines as a PNG (filter type 0) using only the standard library."""
+    colour_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    def chunk(chunk_type, payload):
+        return (struct.pack(">I", len(payload)) + chunk_type + payload
+                + struct.pack(">I", zlib.crc32(chunk_type + payload) & 0xFFFFFFFF))
+
+    raw = b"".join(b"\x00" + row for row in rows)
+    return (PNG_SIGNATURE
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b""))
+
+
+def make_thumbnail(image_path, size):
+    """Return (bytes, content_type) for a thumbnail whose longest edge is at most size."""
+    if Image is not None:
+        with Image.open(image_path) as img:
+            img.thumbnail((size, size))
+            buffer = io.BytesIO()
+            try:
+                img.save(buffer, "WEBP", quality=80)
+                return buffer.getvalue(), "image/webp"
+            except (KeyError, OSError):
+                buffer = io.BytesIO()
+                img.save(buffer, "PNG", optimize=True)
+                return buffer.getvalue(), "image/png"
+
+    with open(image_path, "rb") as f:
+        width, height = png_dimensions(f.read(24))
+    if max(width, height) <= size:
+        # Already small enough: re-encoding with the built-in codec would only cost time (and bytes)
+        return image_path.read_bytes(), "image/png"
+
+    width, height, channels, rows = decode_png(image_path.read_bytes())
+    scale = max(width, height) / size
+
+    # Nearest-neighbour downsample: cheap, and good enough for a gallery tile
+    thumb_width = max(1, round(width / scale))
+    thumb_height = max(1, round(height / scale))
+    columns = [min(int(x * scale), width - 1) * channels for x in range(thumb_width)]
+    thumb_rows = []
+    for y in range(thumb_height):
+        row = rows[min(int(y * scale), height - 1)]
+        thumb_rows.append(b"".join(row[c:c + channels] for c in columns))
+    return encode_png(thumb_width, thumb_height, channels, thumb_rows), "image/png"
+
+
+class Thumbnailer:
+    """
+    Creates and caches history thumbnails under THUMBNAIL_DIR.
+    Thumbnails are made in a background thread after each generation, or
+    queued on first request for items that predate the cache; that request
+    waits up to THUMBNAIL_WAIT for it, then gets a placeholder to retry.
+    """
+
+    def __init__(self, thumb_dir):
+        self.thumb_dir = thumb_dir
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._scheduled = {}  # (id, size) -> Event set once it has been made (or failed)
+
+    @staticmethod
+    def snap_size(size):
+        """Round a requested size up to the nearest allowed thumbnail size."""
+        for allowed in THUMBNAIL_SIZES:
+            if size <= allowed:
+                return allowed
+        return THUMBNAIL_SIZES[-1]
+
+    def _shard_dir(self, image_name):
+        """Thumbnails are sharded by date like the history itself."""
+        shard = history_shard(image_name)
+        return self.thumb_dir / shard if shard else self.thumb_dir
+
+    def find(self, image_name, size):
+        """Return (path, content_type) of a cached thumbnail, or None."""
+        for extension, content_type in ((".webp", "image/webp"), (".png", "image/png")):
+            candidate = self._shard_dir(image_name) / f"{image_name}-{size}{extension}"
+            if candidate.exists():
+                return candidate, content_type
+        return None
+
+    def find_fresh(self, image_name, image_path, size):
+        """Return (path, content_type) of a cached thumbnail no older than its image, or None."""
+        cached = self.find(image_name, size)
+        if cached and cached[0].stat().st_mtime_ns >= image_path.stat().st_mtime_ns:
+            return cached
+        return None
+
+    def get_or_schedule(self, image_name, image_path, size, timeout=THUMBNAIL_WAIT):
+        """
+        Return (path, content_type) of the thumbnail, queueing it to be made
+        and waiting up to timeout if it is not cached; None if it is not ready.
+        """
+        cached = self.find_fresh(image_name, image_path, size)
+        if cached:
+            return cached
+        self.schedule(image_name, image_path, size).wait(timeout)
+        return self.find_fresh(image_name, image_path, size)
+
+    def get_or_create(self, image_name, image_path, size):
+        """Return (path, content_type) for a thumbnail, generating it if necessary."""
+        cached = self.find_fresh(image_name, image_path, size)
+        if cached:
+            return cached
+
+        data, content_type = make_thumbnail(image_path, size)
+        extension = ".webp" if content_type == "image/webp" else ".png"
+        thumb_dir = self._shard_dir(image_name)
+        thumb_dir.mkdir(parents=True, exist_ok=True)
+        thumb_path = thumb_dir / f"{image_name}-{size}{extension}"
+        temp_path = thumb_path.with_name(f".{thumb_path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, thumb_path)
+        return thumb_path, content_type
+
+    def schedule(self, image_name, image_path, size=THUMBNAIL_DEFAULT_SIZE):
+        """Queue a thumbnail to be made in the background, unless it already is; returns an Event set when done."""
+        with self._lock:
+            done = self._scheduled.get((image_name, size))
+            if done is not None:
+                return done
+            done = self._scheduled[(image_name, size)] = threading.Event()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="thumbnailer", daemon=True)
+                self._worker.start()
+        self._queue.put((image_name, image_path, size))
+        return done
+
+    def _run(self):
+        while True:
+            image_name, image_path, size = self._queue.get()
+            try:
+                self.get_or_create(image_name, image_path, size)
+            except Exception as e:
+                print(f"Error creating thumbnail for {image_name}: {e}", flush=True)
+            finally:
+                with self._lock:
+                    self._scheduled.pop((image_name, size)).set()
+
+    def remove(self, image_name):
+        """Delete every cached thumbnail for a history item."""
+        self.remove_many([image_name])
+
+    def remove_many(self, image_names):
+        """Delete every cached thumbnail for some history items, listing each shard directory once."""
+        names_by_dir = {}
+        for image_name in image_names:
+            names_by_dir.setdefault(self._shard_dir(image_name), set()).add(image_name)
+        for thumb_dir, names in names_by_dir.items():
+            try:
+                with os.scandir(thumb_dir) as entries:
+                    thumb_paths = [entry.path for entry in entries if entry.name.rsplit("-", 1)[0] in names]
+            except FileNotFoundError:
+                continue
+            for thumb_path in thumb_paths:
+                try:
+                    os.unlink(thumb_path)
+                except FileNotFoundError:
+                    pass
+
+    def backfill(self, size=THUMBNAIL_DEFAULT_SIZE):
+        """Create missing thumbnails for every history image; returns (created, failed)."""
+        created = failed = 0
+        for image_path in iter_history_files(HISTORY_DIR, ".png"):
+            image_name = image_path.stem
+            if self.find_fresh(image_name, image_path, size):
+                continue
+            try:
+                self.get_or_create(image_name, image_path, size)
+                created += 1
+            except Exception as e:
+                failed += 1
+                print(f"Error creating thumbnail for {image_name}: {e}", flush=True)
+        return created, failed
+
+
+THUMBNAILER = Thumbnailer(THUMBNAIL_DIR)
+THUMBNAIL_PLACEHOLDER = encode_png(1, 1, 4, [b"\x00\x00\x00\x00"])  # Transparent pixel sent while a thumbnail is made
+
+
+class QueueFullError(Exception):
+    """Raised when the generation queue cannot take another job."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Generation queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class GenerationTicket:
+    """A /generate request that is waiting for, or holding, a generation slot."""
+
+    def __init__(self, model, warm=False):
+        self.model = model
+        self.warm = warm  # Only loads the model; not counted as a generation
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.admitted = False
+        self.finished = False
+        self.bypassed = 0
+        self.caused_swap = False
+
+
+class GenerationScheduler:
+    """
+    Admits /generate jobs to Ollama with a global and a per-model concurrency
+    cap, queueing the rest up to a fixed queue length.
+
+    In "fifo" mode queued jobs run in arrival order. In "affinity" mode jobs
+    for the model Ollama already has loaded go first, so fewer multi-GB model
+    swaps happen; a job that has waited AFFINITY_MAX_WAIT seconds or been
+    overtaken AFFINITY_MAX_BYPASS times is run next whatever its model.
+    """
+
+    def __init__(self, max_concurrent, max_per_model, max_queued, mode="fifo"):
+        self.max_concurrent = max_concurrent
+        self.max_per_model = max_per_model
+        self.max_queued = max_queued
+        self.mode = mode
+        self._cond = threading.Condition()
+        self._pending = []
+        self._running = {}
+        self._running_total = 0
+        self._average_duration = 30.0  # Rough seconds per generation, refined as jobs finish
+        self._completed = 0
+        self._rejected = 0
+        self._loaded_model = None
+        self._swaps = 0
+        self._swaps_avoided = 0
+        self._average_swap_seconds = None
+        self._recent = deque(maxlen=WARM_HISTORY_SIZE)  # (monotonic time, model) of recent submissions
+        self._idle_since = time.monotonic()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback() (without the lock held) whenever the queue changes."""
+        self._listeners.append(callback)
+
+    def record_load_time(self, ticket, seconds):
+        """Feed back Ollama's reported model load time, used to estimate time saved."""
+        with self._cond:
+            if ticket.caused_swap and seconds > 0:
+                if self._average_swap_seconds is None:
+                    self._average_swap_seconds = seconds
+                else:
+                    self._average_swap_seconds += (seconds - self._average_swap_seconds) * 0.2
+
+    def submit(self, model, warm=False):
+        """
+        Queue a job for model and return its ticket, or raise QueueFullError.
+        A warm ticket only loads the model and is left out of the statistics.
+        """
+        with self._cond:
+            if len(self._pending) >= self.max_queued:
+                self._rejected += 1
+                raise QueueFullError(self._retry_after())
+            ticket = GenerationTicket(model, warm)
+            if not warm:
+                self._recent.append((ticket.enqueued_at, model))
+            self._pending.append(ticket)
+            self._dispatch()
+        self._notify_listeners()
+        return ticket
+
+    def wait(self, ticket, timeout):
+        """
+        Wait up to timeout seconds for admission or a queue change; return
+        the queue position (0 once admitted or withdrawn).
+        """
+        with self._cond:
+            if not ticket.admitted and timeout:
+                self._cond.wait(timeout)
+            return self._position(ticket)
+
+    def position(self, ticket):
+        with self._cond:
+            return self._position(ticket)
+
+    def withdraw(self, ticket):
+        """Give up a ticket only if it is still waiting; returns True if it was."""
+        with self._cond:
+            if ticket.admitted or ticket.finished:
+                return False
+            ticket.finished = True
+            self._pending.remove(ticket)
+            self._dispatch()
+            if not self._running_total and not self._pending:
+                self._idle_since = time.monotonic()
+        self._notify_listeners()
+        return True
+
+    def release(self, ticket):
+        """Give up a ticket, whether it is still waiting or already running."""
+        with self._cond:
+            if ticket.finished:
+                return
+            ticket.finished = True
+            if ticket.admitted:
+                self._running[ticket.model] -= 1
+                if not self._running[ticket.model]:
+                    del self._running[ticket.model]
+                self._running_total -= 1
+                if not ticket.warm:
+                    self._completed += 1
+                    duration = time.monotonic() - ticket.started_at
+                    self._average_duration += (duration - self._average_duration) * 0.2
+            else:
+                self._pending.remove(ticket)
+            self._dispatch()
+            if not self._running_total and not self._pending:
+                self._idle_since = time.monotonic()
+        self._notify_listeners()
+
+    def recent_requests(self):
+        """(monotonic time, model) of the last WARM_HISTORY_SIZE jobs submitted, oldest first."""
+        with self._cond:
+            return list(self._recent)
+
+    def idle_seconds(self):
+        """Seconds since the last job finished, or 0 while any job is running or queued."""
+        with self._cond:
+            if self._running_total or self._pending:
+                return 0.0
+            return time.monotonic() - self._idle_since
+
+    def _notify_listeners(self):
+        for callback in self._listeners:
+            callback()
+
+    def stats(self):
+        with self._cond:
+            swap_seconds = self._average_swap_seconds
+            return {
+                "mode": self.mode,
+                "running": dict(self._running),
+                "queued": len(self._pending),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "average_duration": round(self._average_duration, 2),
+                "loaded_model": self._loaded_model,
+                "model_swaps": self._swaps,
+                "model_swaps_avoided": self._swaps_avoided,
+                "average_swap_seconds": None if swap_seconds is None else round(swap_seconds, 2),
+                "estimated_seconds_saved": round(self._swaps_avoided * (swap_seconds or 0), 2),
+            }
+
+    def _position(self, ticket):
+        if ticket.admitted:
+            return 0
+        ordered = self._ordered_pending()
+        return ordered.index(ticket) + 1 if ticket in ordered else 0
+
+    def _ordered_pending(self):
+        """Pending tickets in the order the current mode would run them."""
+        if self.mode != "affinity" or not self._pending:
+            return list(self._pending)
+        oldest = self._pending[0]
+        if (oldest.bypassed >= AFFINITY_MAX_BYPASS
+                or time.monotonic() - oldest.enqueued_at >= AFFINITY_MAX_WAIT):
+            return list(self._pending)
+        resident = set(self._running)
+        if self._loaded_model is not None:
+            resident.add(self._loaded_model)
+        # Stable sort: resident models first, arrival order otherwise
+        return sorted(self._pending, key=lambda t: t.model not in resident)
+
+    def _retry_after(self):
+        backlog = len(self._pending) + self._running_total
+        return max(1, math.ceil(self._average_duration * backlog / self.max_concurrent))
+
+    def _dispatch(self):
+        """Admit as many pending jobs as the caps allow (caller holds the lock)."""
+        for ticket in self._ordered_pending():
+            if self._running_total >= self.max_concurrent:
+                break
+            if self._running.get(ticket.model, 0) >= self.max_per_model:
+                continue
+
+            # What strict arrival order would have run instead, for the swap statistics
+            fifo_choice = next((t for t in self._pending
+                                if self._running.get(t.model, 0) < self.max_per_model), ticket)
+            if fifo_choice is not ticket and fifo_choice.model != ticket.model:
+                self._swaps_avoided += 1
+            for older in self._pending:
+                if older is ticket:
+                    break
+                older.bypassed += 1
+
+            if self._loaded_model is not None and ticket.model != self._loaded_model:
+                self._swaps += 1
+                ticket.caused_swap = True
+            self._loaded_model = ticket.model
+
+            self._pending.remove(ticket)
+            ticket.admitted = True
+            ticket.started_at = time.monotonic()
+            METRIC_QUEUE_WAIT.observe(ticket.started_at - ticket.enqueued_at, (metric_model_label(ticket.model),))
+            self._running[ticket.model] = self._running.get(ticket.model, 0) + 1
+            self._running_total += 1
+        # Wake every waiter: admissions also move the others up the queue
+        self._cond.notify_all()
+
+
+GENERATION_SCHEDULER = GenerationScheduler(MAX_CONCURRENT_GENERATIONS, MAX_CONCURRENT_PER_MODEL,
+                                           MAX_QUEUED_GENERATIONS, SCHEDULING_MODE)
+METRICS.gauge_function("ollama_proxy_queued_generations", "Generations waiting for a slot.",
+                       lambda: GENERATION_SCHEDULER.stats()["queued"])
+METRICS.gauge_function("ollama_proxy_running_generations", "Generations running in Ollama.",
+                       lambda: sum(GENERATION_SCHEDULER.stats()["running"].values()))
+METRICS.gauge_function("ollama_proxy_model_swaps_total", "Times Ollama had to switch to a different model.",
+                       lambda: GENERATION_SCHEDULER.stats()["model_swaps"], kind="counter")
+
+
+class ModelResidencyManager:
+    """
+    Keeps cold model loads off the user-facing path. A background thread keeps
+    a fresh copy of the installed image models (so /models is answered without
+    asking Ollama) and of the models Ollama has loaded (/api/ps), loads the
+    PRELOAD_MODELS at startup and, once nothing has run for WARM_IDLE_SECONDS,
+    loads the model recent requests favour if it is not loaded already.
+
+    A warm-up is Ollama's empty-prompt /generate with keep_alive. It goes
+    through GENERATION_SCHEDULER like a generation, so it never runs beside
+    one and the scheduler knows which model is loaded.
+    """
+
+    def __init__(self, preload=(), predictive=PREDICTIVE_WARMING):
+        self.preload = list(preload)
+        self.predictive = predictive
+        self._lock = threading.Lock()
+        self._models = None  # Installed image model names, in Ollama's order
+        self._models_fetched_at = 0.0
+        self._resident = None  # Trimmed /api/ps entries
+        self._resident_fetched_at = 0.0
+        self._error = None  # Last failure talking to Ollama, until a request succeeds
+        self._warming = None
+        self._last_warmed = {}  # Model -> monotonic time of its last warm-up
+        self._warmups = deque(maxlen=10)
+
+    def start(self):
+        threading.Thread(target=self._run, name="model-residency", daemon=True).start()
+
+    def available_models(self):
+        """
+        The installed models that are in IMAGE_GEN_MODEL_LIST, from the cache
+        if it is under MODELS_CACHE_TTL old. Raises OllamaHTTPError or
+        OllamaConnectionError if Ollama has to be asked and cannot answer.
+        """
+        with self._lock:
+            if self._models is not None and time.monotonic() - self._models_fetched_at < MODELS_CACHE_TTL:
+                return list(self._models)
+        return self.refresh_models()
+
+    def refresh_models(self):
+        models = [name for name in OLLAMA_BACKENDS.installed_models() if name in IMAGE_GEN_MODEL_LIST]
+        with self._lock:
+            self._models = models
+            self._models_fetched_at = time.monotonic()
+        return list(models)
+
+    def refresh_resident(self):
+        """Ask every Ollama backend which models are loaded; returns their names."""
+        resident = [{key: model.get(key) for key in ("name", "size", "size_vram", "expires_at", "backend")}
+                    for model in OLLAMA_BACKENDS.loaded_models()]
+        with self._lock:
+            self._resident = resident
+            self._resident_fetched_at = time.monotonic()
+        return {model["name"] for model in resident}
+
+    def demand(self):
+        """Recent requests per model, each weighted by recency (halving every WARM_HALF_LIFE)."""
+        now = time.monotonic()
+        scores = {}
+        for requested_at, model in GENERATION_SCHEDULER.recent_requests():
+            scores[model] = scores.get(model, 0.0) + 0.5 ** ((now - requested_at) / WARM_HALF_LIFE)
+        return scores
+
+    def warm(self, model, reason):
+        """Load model into Ollama, waiting for a generation slot first; returns True if it loaded."""
+        try:
+            ticket = GENERATION_SCHEDULER.submit(model, warm=True)
+        except QueueFullError:
+            return False
+        with self._lock:
+            self._warming = model
+            self._last_warmed[model] = time.monotonic()
+        body = {"model": model, "prompt": "", "stream": False}
+        if MODEL_KEEP_ALIVE is not None:
+            body["keep_alive"] = MODEL_KEEP_ALIVE
+        error = None
+        try:
+            while not ticket.admitted:
+                GENERATION_SCHEDULER.wait(ticket, QUEUE_POSITION_INTERVAL)
+            started = time.monotonic()
+            with OLLAMA_BACKENDS.request("POST", "/generate", body=json.dumps(body).encode("utf-8"),
+                                         model=model) as response:
+                response.read()
+        except (OllamaHTTPError, OllamaConnectionError) as e:
+            error = str(e)
+        finally:
+            GENERATION_SCHEDULER.release(ticket)
+            with self._lock:
+                self._warming = None
+
+        METRIC_MODEL_WARMUPS.inc(labels=(model, reason, "error" if error else "loaded"))
+        record = {"model": model, "reason": reason, "at": datetime.now().isoformat(timespec="seconds")}
+        if error:
+            record["error"] = error
+            print(f"⚠️  Could not load {model} ({reason}): {error}", flush=True)
+        else:
+            record["seconds"] = round(time.monotonic() - started, 2)
+            print(f"🔥 Loaded {model} ({reason}) in {record['seconds']}s", flush=True)
+        with self._lock:
+            self._warmups.append(record)
+        self._poll(refresh_models=False)
+        return error is None
+
+    def status(self):
+        """What /models/status reports, asking Ollama (/api/ps) for the loaded models first."""
+        self._poll(refresh_models=False)
+        with self._lock:
+            checked_at = self._resident_fetched_at
+            return {
+                "available": self._models,
+                "resident": self._resident,
+                "checked_seconds_ago": round(time.monotonic() - checked_at, 1) if checked_at else None,
+                "error": self._error,
+                "loaded_model": GENERATION_SCHEDULER.stats()["loaded_model"],
+                "warming": self._warming,
+                "keep_alive": MODEL_KEEP_ALIVE,
+                "preload": self.preload,
+                "predictive_warming": self.predictive,
+                "demand": {model: round(score, 2) for model, score in self.demand().items()},
+                "recent_warmups": list(self._warmups),
+            }
+
+    def _poll(self, refresh_models=True):
+        """Refresh the cached model lists, remembering (and logging once) any failure."""
+        try:
+            if refresh_models:
+                self.refresh_models()
+            self.refresh_resident()
+        except (OllamaHTTPError, OllamaConnectionError, ValueError, KeyError) as e:
+            with self._lock:
+                first = self._error != str(e)
+                self._error = str(e)
+            if first:
+                print(f"⚠️  Cannot check Ollama's models: {e}", flush=True)
+            return False
+        with self._lock:
+            self._error = None
+        return True
+
+    def _maybe_warm(self):
+        """Warm the most demanded model if Ollama has been idle and does not have it loaded."""
+        if GENERATION_SCHEDULER.idle_seconds() < WARM_IDLE_SECONDS:
+            return
+        demand = self.demand()
+        if not demand:
+            return
+        model = max(demand, key=demand.get)
+        with self._lock:
+            last_warmed = self._last_warmed.get(model)
+            available = self._models
+        if demand[model] < WARM_MIN_DEMAND or (available is not None and model not in available):
+            return
+        if last_warmed is not None and time.monotonic() - last_warmed < WARM_RETRY_INTERVAL:
+            return
+        try:
+            if model in self.refresh_resident():
+                return
+        except (OllamaHTTPError, OllamaConnectionError, ValueError):
+            return
+        self.warm(model, "predicted")
+
+    def _run(self):
+        self._poll()
+        for model in self.preload:
+            self.warm(model, "preload")
+        while True:
+            time.sleep(min(MODEL_STATUS_INTERVAL, WARM_IDLE_SECONDS) / 2)
+            with self._lock:
+                now = time.monotonic()
+                models_due = now - self._models_fetched_at >= MODELS_CACHE_TTL / 2
+                resident_due = now - self._resident_fetched_at >= MODEL_STATUS_INTERVAL
+            if models_due or resident_due:
+                self._poll(refresh_models=models_due)
+            if self.predictive:
+                self._maybe_warm()
+
+
+MODEL_RESIDENCY = ModelResidencyManager(PRELOAD_MODELS)
+
+
+def parse_generate_request(body):
+    """
+    Parse a /generate request body; returns (request_data, body to send to Ollama,
+    use_cache). Raises json.JSONDecodeError for a malformed body.
+    """
+    request_data = json.loads(body)
+    print(json.dumps(request_data, indent=4), flush=True)
+
+    # Convert any newline or carriage returns in the prompt to spaces.
+    request_data['prompt'] = request_data['prompt'].replace('\n', ' ').replace('\r', ' ')
+
+    # "cache": false asks for a fresh generation; it is ours, so Ollama never sees it
+    use_cache = request_data.pop("cache", True) is not False
+    if MODEL_KEEP_ALIVE is not None:
+        request_data.setdefault("keep_alive", MODEL_KEEP_ALIVE)
+
+    return request_data, json.dumps(request_data), use_cache
+
+
+def generation_settings(request_data):
+    """The settings saved with a history item (and which identify a seeded generation)."""
+    return {
+        "model": request_data.get("model", ""),
+        "prompt": request_data.get("prompt", ""),
+        "seed": request_data.get("seed", 0),
+        "width": request_data.get("width", 512),
+        "height": request_data.get("height", 512),
+        "steps": request_data.get("steps", 12)
+    }
+
+
+def generation_cache_key(settings):
+    """
+    Canonical hash of a generation's settings, or None if it is not repeatable.
+    Only an explicit, non-zero integer seed makes a generation deterministic.
+    """
+    seed = settings.get("seed")
+    if not isinstance(seed, int) or isinstance(seed, bool) or seed == 0:
+        return None
+    canonical = json.dumps({key: settings.get(key) for key in ("model", "prompt", "seed", "width", "height", "steps")},
+                           sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Maps the settings hash of seeded generations to the history item that holds
+    the result, so an identical request is answered from disk instead of the GPU.
+    The images themselves are the HISTORY_DIR files; this is a bounded LRU of
+    references to them.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> history id
+        self._keys = {}  # history id -> key
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def populate(self, items):
+        """Load references from history metadata, oldest first so the newest are kept."""
+        for item in items:
+            key = generation_cache_key(item.get("settings", {}))
+            if key and item.get("id"):
+                self.store(key, item["id"])
+
+    def lookup(self, key):
+        """Return the history id for key if its image still exists (or is queued to be written), else None."""
+        with self._lock:
+            image_name = self._entries.get(key)
+            if image_name is not None:
+                image_path = resolve_history_path(image_name, ".png")
+                if HISTORY_WRITER.is_pending(image_name) or (image_path and image_path.exists()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return image_name
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def store(self, key, image_name):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = image_name
+            self._keys[image_name] = key
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def forget(self, image_name):
+        with self._lock:
+            key = self._keys.get(image_name)
+            if key is not None:
+                self._drop(key)
+
+    def count_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def _drop(self, key):
+        image_name = self._entries.pop(key)
+        if self._keys.get(image_name) == key:
+            del self._keys[image_name]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_MAX_ENTRIES)
+
+
+def find_cached_generation(request_data, use_cache):
+    """Return the history id of an identical earlier generation, or None."""
+    key = generation_cache_key(generation_settings(request_data))
+    if key is None:
+        return None
+    if not use_cache:
+        RESULT_CACHE.count_bypass()
+        return None
+    return RESULT_CACHE.lookup(key)
+
+
+def iter_cached_generation(image_name, request_data):
+    """Yield the bytes of a synthetic NDJSON "done" line for a cached result."""
+    return iter_history_done_line(image_name, {
+        "model": request_data.get("model", ""),
+        "created_at": datetime.now().astimezone().isoformat(),
+        "response": "",
+        "done": True,
+        "done_reason": "stop",
+        "cached": True,
+        "history_id": image_name,
+    })
+
+
+def iter_history_done_line(image_name, fields):
+    """
+    Yield the bytes of an NDJSON line holding fields plus the stored PNG of a
+    history item as "image", base64-encoding the PNG piece by piece. If the
+    item could not be written to the history, yield an error line instead.
+    """
+    HISTORY_WRITER.wait(image_name)
+    failure = HISTORY_WRITER.failure(image_name)
+    if failure:
+        error_fields = {key: fields[key] for key in ("offset", "job_id") if key in fields}
+        error_fields["error"] = f"Could not save the image: {failure}"
+        yield (json.dumps(error_fields) + "\n").encode("utf-8")
+        return
+    image_path = resolve_history_path(image_name, ".png")
+    head = json.dumps(fields)
+    yield (head[:-1] + ', "image": "').encode("utf-8")
+    with open(image_path, "rb") as f:
+        while True:
+            data = f.read(STREAM_CHUNK_SIZE // 4 * 3)  # Whole base64 quanta, so pieces concatenate
+            if not data:
+                break
+            yield binascii.b2a_base64(data, newline=False)
+    yield b'"}\n'
+
+
+def record_generation_duration(ticket, request_data, started_at=None):
+    """Observe a generation's duration, from started_at (a batch job's own start) or its ticket's admission."""
+    settings = generation_settings(request_data)
+    METRIC_GENERATION_DURATION.observe(time.monotonic() - (started_at or ticket.started_at),
+                                       (metric_model_label(settings["model"]),
+                                        metric_resolution_label(settings["width"], settings["height"])))
+
+
+class ImageStreamDecoder:
+    """
+    Watches the NDJSON bytes streamed from Ollama without buffering whole lines.
+    Ordinary lines are small and only get a cheap check for "done":true; the
+    base64 "image" field is decoded chunk by chunk into a temporary file in
+    HISTORY_DIR, so a multi-megabyte final line never sits in memory.
+    """
+
+    IMAGE_KEY = re.compile(rb'"image"\s*:\s*"')
+    DONE_MARKER = re.compile(rb'"done"\s*:\s*true')
+
+    def __init__(self):
+        self._line = bytearray()  # Current line, minus the contents of any image field
+        self._searched_to = 0
+        self._in_image = False
+        self._base64_carry = b""
+        self._temp_file = None
+        self._failed = False
+        self.image_path = None  # Temporary file holding the final image, once complete
+        self.done_fields = None  # The final line's fields, without the image
+        self.on_line = None  # Called with each complete line, minus the contents of any image field
+
+    def feed(self, chunk):
+        while chunk:
+            if self._in_image:
+                end = chunk.find(b'"')
+                self._decode(chunk if end < 0 else chunk[:end])
+                if end < 0:
+                    return
+                self._finish_image()
+                chunk = chunk[end:]
+                continue
+
+            newline = chunk.find(b"\n")
+            piece = chunk if newline < 0 else chunk[:newline]
+            # Re-check a few bytes in case the key was split across chunks
+            search_from = max(len(self._line) - 16, self._searched_to)
+            self._line += piece
+            match = self.IMAGE_KEY.search(self._line, search_from)
+            if match:
+                # Keep everything up to the opening quote; the value itself goes to disk
+                consumed = match.end() - (len(self._line) - len(piece))
+                del self._line[match.end():]
+                self._searched_to = match.end()
+                self._start_image()
+                chunk = chunk[consumed:]
+                continue
+            if newline < 0:
+                return
+            self._finish_line()
+            chunk = chunk[newline + 1:]
+
+    def finish(self):
+        """Handle a final line that arrived without a trailing newline."""
+        if self._in_image:
+            # The stream ended inside the image field
+            self._in_image = False
+            self._discard_temp()
+            self._line.clear()
+            self._searched_to = 0
+        elif self._line:
+            self._finish_line()
+
+    def close(self):
+        """Remove any temporary file that was not taken over by the caller."""
+        self._discard_temp()
+        self._discard_path(self.image_path)
+        self.image_path = None
+
+    def _start_image(self):
+        self._discard_temp()
+        self._in_image = True
+        self._failed = False
+        self._base64_carry = b""
+        ensure_history_dir()
+        temp_path = HISTORY_DIR / f".{uuid.uuid4().hex}.png.tmp"
+        self._temp_file = open(temp_path, "wb")
+
+    def _decode(self, data):
+        if self._failed or not data:
+            return
+        # JSON may escape "/" as "\/"; base64 never contains a backslash
+        data = self._base64_carry + data.replace(b"\\", b"")
+        usable = len(data) - len(data) % 4
+        self._base64_carry = data[usable:]
+        try:
+            self._temp_file.write(binascii.a2b_base64(data[:usable]))
+        except binascii.Error as e:
+            print(f"Error decoding streamed image: {e}", flush=True)
+            self._failed = True
+
+    def _finish_image(self):
+        self._in_image = False
+        if self._base64_carry and not self._failed:
+            self._failed = True
+            print("Error decoding streamed image: truncated base64 data", flush=True)
+        self._temp_file.close()
+        if self._failed:
+            self._discard_temp()
+
+    def _finish_line(self):
+        line = bytes(self._line)
+        self._line.clear()
+        self._searched_to = 0
+        if self.on_line is not None:
+            self.on_line(line)
+        temp_file, self._temp_file = self._temp_file, None
+        if not self.DONE_MARKER.search(line):
+            # An image on a progress line is not the final image
+            if temp_file is not None:
+                os.unlink(temp_file.name)
+            return
+        try:
+            # Small now: the image value was left out, leaving "image":""
+            self.done_fields = json.loads(line)
+        except ValueError:
+            self.done_fields = {"done": True}
+        if temp_file is not None:
+            self._discard_path(self.image_path)
+            self.image_path = Path(temp_file.name)
+
+    def _discard_temp(self):
+        if self._temp_file is not None:
+            self._temp_file.close()
+            self._discard_path(Path(self._temp_file.name))
+            self._temp_file = None
+
+    @staticmethod
+    def _discard_path(path):
+        if path is not None:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def store_history_files(image_name, image_temp_path, metadata):
+    """
+    Move a fully written PNG into the history under image_name and save its
+    metadata beside it; returns the image's path. Both files are renamed into
+    place, the image first: an item is listed once its JSON exists.
+    """
+    shard = history_shard(image_name)
+    item_dir = HISTORY_DIR / shard if shard else HISTORY_DIR
+    item_dir.mkdir(parents=True, exist_ok=True)
+    image_path = item_dir / f"{image_name}.png"
+    os.replace(image_temp_path, image_path)
+
+    json_path = item_dir / f"{image_name}.json"
+    temp_json_path = item_dir / f".{image_name}.json.{uuid.uuid4().hex}.tmp"
+    with open(temp_json_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(temp_json_path, json_path)
+    return image_path
+
+
+class PendingHistoryItem:
+    """A finished image waiting for HistoryWriter to save it."""
+
+    def __init__(self, image_name, image_temp_path, metadata):
+        self.image_name = image_name
+        self.image_temp_path = image_temp_path
+        self.metadata = metadata
+        self.saved = False
+        self.error = None
+
+
+class HistoryWriter:
+    """
+    Saves finished images to the history on a background thread, so a
+    generation's response never waits on the disk (unless HISTORY_WRITE_QUEUE_SIZE
+    images are already waiting). Queued items are written in batches: every
+    file is written and fsynced, then renamed into place, then each directory
+    is fsynced once and the batch goes into the history database in one
+    transaction. A request for an item still in the queue waits for it; if
+    the item could not be written, failure() says why.
+
+    The same thread applies the retention limits (HISTORY_MAX_ITEMS,
+    HISTORY_MAX_BYTES, HISTORY_MAX_AGE_DAYS) after each batch and every
+    HISTORY_RETENTION_INTERVAL seconds, deleting the oldest items first along
+    with their thumbnails, result cache entries and database rows. It keeps
+    running totals of the history's items and bytes, counted once from the
+    index and then updated as items are saved and deleted, so a check only
+    walks the history (from the oldest end) when a limit has been passed.
+    """
+
+    def __init__(self, max_queued=HISTORY_WRITE_QUEUE_SIZE):
+        self._queue = queue.Queue(max_queued)
+        self._cond = threading.Condition()
+        self._pending = {}  # id -> PendingHistoryItem, until it is on disk (or failed)
+        self._failed = OrderedDict()  # id -> why it could not be written, the last HISTORY_WRITE_FAILURES_KEPT
+        self._totals_lock = threading.Lock()
+        self._tracked = None  # id -> (timestamp, bytes of its PNG and JSON), once counted from the index
+        self._oldest = []  # Heap of tracked ids, oldest first; deleted ids are dropped as they surface
+        self._total_bytes = 0
+        self._worker = None
+        self.max_items = HISTORY_MAX_ITEMS
+        self.max_bytes = HISTORY_MAX_BYTES
+        self.max_age_days = HISTORY_MAX_AGE_DAYS
+
+    def start(self):
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._worker.start()
+
+    def submit(self, image_name, image_temp_path, metadata):
+        """Queue a finished image (a temporary file in HISTORY_DIR) to be saved as image_name."""
+        self.start()
+        with self._cond:
+            self._pending[image_name] = PendingHistoryItem(image_name, image_temp_path, metadata)
+        self._queue.put(self._pending[image_name])
+
+    def wait(self, image_name, timeout=HISTORY_WRITE_WAIT):
+        """If image_name is waiting to be written, wait until it has been; False if it still has not."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while image_name in self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def is_pending(self, image_name):
+        """True while image_name is queued and not yet written (or failed)."""
+        with self._cond:
+            return image_name in self._pending
+
+    def failure(self, image_name):
+        """Why image_name could not be written to the history, or None if it was (or is still queued)."""
+        with self._cond:
+            return self._failed.get(image_name)
+
+    def flush(self, timeout=HISTORY_WRITE_WAIT):
+        """Wait until everything queued so far has been written; False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def queued(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        self._check_retention()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=HISTORY_RETENTION_INTERVAL)]
+            except queue.Empty:
+                self._check_retention()
+                continue
+            while len(batch) < HISTORY_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                print(f"Error saving to history: {e}", flush=True)
+                for item in batch:
+                    if not item.saved and item.error is None:
+                        item.error = str(e)
+            finally:
+                for item in batch:
+                    if item.error is not None:
+                        RESULT_CACHE.forget(item.image_name)  # Stored when it was queued
+                with self._cond:
+                    for item in batch:
+                        self._pending.pop(item.image_name, None)
+                        if item.error is not None:
+                            self._failed[item.image_name] = item.error
+                    while len(self._failed) > HISTORY_WRITE_FAILURES_KEPT:
+                        self._failed.popitem(last=False)
+                    self._cond.notify_all()
+            self._check_retention()
+
+    def _check_retention(self):
+        try:
+            self._apply_retention()
+        except Exception as e:
+            print(f"⚠️  Could not apply the history retention limits: {e}", flush=True)
+
+    def _write_batch(self, batch):
+        started = time.monotonic()
+        written = []
+        directories = set()
+        for item in batch:
+            try:
+                directories.add(self._write_files(item))
+                written.append(item)
+            except OSError as e:
+                print(f"Error saving {item.image_name} to history: {e}", flush=True)
+                item.error = str(e)
+                for path in (item.image_temp_path, self._temp_json_path(item)):
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+        installed = []
+        for item in written:
+            try:
+                installed.append((item, self._install(item)))
+                item.saved = True
+            except OSError as e:
+                print(f"Error saving {item.image_name} to history: {e}", flush=True)
+                item.error = str(e)
+        # The renames are made durable by syncing each directory once, for the whole batch
+        for directory in directories:
+            fsync_directory(directory)
+        METRIC_HISTORY_WRITE.observe(time.monotonic() - started)
+
+        for item, image_path in installed:
+            HISTORY_INDEX.add(item.image_name, item.metadata)
+            THUMBNAILER.schedule(item.image_name, image_path)
+            print(f"✓ Saved image to history: {image_path.name}", flush=True)
+        try:
+            HISTORY_STORE.add_many([item.metadata for item, _ in installed])
+        except sqlite3.Error as e:
+            print(f"Error adding {len(installed)} items to the history database: {e}", flush=True)
+
+    @staticmethod
+    def _item_dir(image_name):
+        shard = history_shard(image_name)
+        return HISTORY_DIR / shard if shard else HISTORY_DIR
+
+    @staticmethod
+    def _temp_json_path(item):
+        return item.image_temp_path.with_name(f".{item.image_name}.json.tmp")
+
+    def _write_files(self, item):
+        """Write the metadata next to the image's temporary file and fsync both; returns the item's directory."""
+        item_dir = self._item_dir(item.image_name)
+        item_dir.mkdir(parents=True, exist_ok=True)
+        with open(item.image_temp_path, "r+b") as f:
+            os.fsync(f.fileno())
+        with open(self._temp_json_path(item), "w") as f:
+            json.dump(item.metadata, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        return item_dir
+
+    def _install(self, item):
+        """Rename an item's files into place, the image first: an item is listed once its JSON exists."""
+        item_dir = self._item_dir(item.image_name)
+        image_path = item_dir / f"{item.image_name}.png"
+        json_path = item_dir / f"{item.image_name}.json"
+        os.replace(item.image_temp_path, image_path)
+        os.replace(self._temp_json_path(item), json_path)
+        self.track(item.image_name, item.metadata.get("timestamp"), image_path)
+        return image_path
+
+    def track(self, image_name, timestamp, image_path):
+        """Count an item just saved into the history (by this writer or an import) in the retention totals."""
+        size = self._item_size(image_path) if self.max_bytes else 0
+        with self._totals_lock:
+            if self._tracked is None:
+                return  # Not counted yet; the count from the index will include it
+            previous = self._tracked.get(image_name)
+            if previous is None:
+                heapq.heappush(self._oldest, image_name)
+            else:
+                self._total_bytes -= previous[1]
+            self._tracked[image_name] = (timestamp, size)
+            self._total_bytes += size
+
+    def untrack(self, image_names):
+        """Take deleted items out of the retention totals."""
+        with self._totals_lock:
+            if self._tracked is None:
+                return
+            for image_name in image_names:
+                previous = self._tracked.pop(image_name, None)
+                if previous is not None:
+                    self._total_bytes -= previous[1]
+            if len(self._oldest) > 2 * len(self._tracked) + HISTORY_WRITE_QUEUE_SIZE:
+                # Deleted ids are normally dropped as they reach the top; rebuild if many have piled up
+                self._oldest = sorted(self._tracked)
+
+    @staticmethod
+    def _item_size(image_path):
+        size = 0
+        for path in (image_path, image_path.with_suffix(".json")):
+            try:
+                size += path.stat().st_size
+            except OSError:
+                pass
+        return size
+
+    def _count_history(self):
+        """Count the items and bytes already in the history, once, from the index."""
+        history_items, _, _ = HISTORY_INDEX.page()
+        tracked = {}
+        for item in history_items:
+            image_name = item["id"]
+            image_path = resolve_history_path(image_name, ".png") if self.max_bytes else None
+            tracked[image_name] = (item.get("timestamp"), self._item_size(image_path) if image_path else 0)
+        with self._totals_lock:
+            self._tracked = tracked
+            self._oldest = sorted(tracked)  # A sorted list is already a heap
+            self._total_bytes = sum(size for _, size in tracked.values())
+
+    def _oldest_item(self):
+        """(id, timestamp, bytes) of the oldest tracked item, or None; call with _totals_lock held."""
+        while self._oldest:
+            image_name = self._oldest[0]
+            if image_name in self._tracked:
+                timestamp, size = self._tracked[image_name]
+                return image_name, timestamp, size
+            heapq.heappop(self._oldest)
+        return None
+
+    def _apply_retention(self):
+        """Delete the oldest history items beyond the retention limits; returns how many went."""
+        if not (self.max_items or self.max_bytes or self.max_age_days):
+            return 0
+        if self._tracked is None:
+            self._count_history()
+        cutoff = (datetime.now() - timedelta(days=self.max_age_days)).isoformat() if self.max_age_days else None
+        expired = {}  # id -> bytes
+        with self._totals_lock:
+            count = len(self._tracked)
+            total_bytes = self._total_bytes
+            # Oldest first, while any limit is still passed
+            while True:
+                oldest = self._oldest_item()
+                if oldest is None:
+                    break
+                image_name, timestamp, size = oldest
+                if image_name not in expired:
+                    if not ((self.max_items and count > self.max_items)
+                            or (self.max_bytes and total_bytes > self.max_bytes)
+                            or (cutoff and timestamp and timestamp < cutoff)):
+                        break
+                    expired[image_name] = size
+                    count -= 1
+                    total_bytes -= size
+                heapq.heappop(self._oldest)
+        if not expired:
+            return 0
+
+        try:
+            deleted = delete_history_items(list(expired))  # Which takes them out of the totals
+        except Exception:
+            with self._totals_lock:
+                for image_name in expired:
+                    if image_name in self._tracked:
+                        heapq.heappush(self._oldest, image_name)
+            raise
+        METRIC_HISTORY_EVICTIONS.inc(len(deleted))
+        print(f"🧹 Retention limits removed {len(deleted)} old history items", flush=True)
+        return len(deleted)
+
+
+def fsync_directory(directory):
+    """Make renames into directory durable (where directories can be opened; not on Windows)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+HISTORY_WRITER = HistoryWriter()
+METRICS.gauge_function("ollama_proxy_history_write_queue", "Finished images waiting to be written to the history.",
+                       HISTORY_WRITER.queued)
+
+
+def save_generation_to_history(image_temp_path, request_data):
+    """
+    Queue a decoded image to be saved in its HISTORY_DIR shard with its
+    metadata (see HistoryWriter); returns the history id it will have.
+    """
+    # A unique id; the date at its start picks the YYYY/MM/DD shard directory
+    now = datetime.now()
+    timestamp = new_history_id(now)
+
+    # Prepare metadata matching the local storage format
+    metadata = {
+        "id": timestamp,
+        "timestamp": now.isoformat(),
+        "settings": generation_settings(request_data)
+    }
+
+    HISTORY_WRITER.submit(timestamp, image_temp_path, metadata)
+    # Cached now, not once written: a repeat request meanwhile waits for the write instead of regenerating
+    cache_key = generation_cache_key(metadata["settings"])
+    if cache_key:
+        RESULT_CACHE.store(cache_key, timestamp)
+    return timestamp
+
+
+def parse_batch_request(body):
+    """
+    Parse a /generate/batch body into (jobs, use_cache), where jobs are
+    /generate request dicts. The body is a /generate request plus a "sweep"
+    object mapping settings to lists of values, e.g.
+    {"sweep": {"prompt": ["a cat", "a dog"], "seed": {"start": 1, "count": 4}}};
+    every combination becomes a job, the last setting varying fastest.
+    Raises ValueError (json.JSONDecodeError included) for an invalid body.
+    """
+    request_data = json.loads(body)
+    if not isinstance(request_data, dict):
+        raise ValueError("the body must be a JSON object")
+    use_cache = request_data.pop("cache", True) is not False
+    sweep = request_data.pop("sweep", None) or {}
+    if not isinstance(sweep, dict):
+        raise ValueError("sweep must be an object")
+    unknown = [key for key in sweep if key not in BATCH_SWEEP_KEYS]
+    if unknown:
+        raise ValueError(f"cannot sweep {', '.join(unknown)} (only {', '.join(BATCH_SWEEP_KEYS)})")
+
+    axes = []
+    for key, values in sweep.items():
+        if key == "seed" and isinstance(values, dict):
+            start, count = int(values.get("start", 1)), int(values.get("count", 1))
+            values = list(range(start, start + count))
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"sweep.{key} must be a non-empty list")
+        axes.append((key, values))
+    if MODEL_KEEP_ALIVE is not None:
+        request_data.setdefault("keep_alive", MODEL_KEEP_ALIVE)
+    job_count = math.prod(len(values) for _, values in axes)
+    if job_count > BATCH_MAX_JOBS:
+        raise ValueError(f"the sweep expands to {job_count} jobs; the limit is {BATCH_MAX_JOBS}")
+
+    jobs = []
+    for combination in itertools.product(*(values for _, values in axes)):
+        job = dict(request_data, **dict(zip((key for key, _ in axes), combination)))
+        # Convert any newline or carriage returns in the prompt to spaces, as for /generate
+        job["prompt"] = str(job.get("prompt", "")).replace('\n', ' ').replace('\r', ' ')
+        jobs.append(job)
+    print(f"Batch of {len(jobs)} jobs: {json.dumps(request_data)} sweeping {json.dumps(sweep)}", flush=True)
+    return jobs, use_cache
+
+
+class JobLineTagger:
+    """
+    Adds "job": N to every JSON object line passing through, at the byte level,
+    so a job's streamed NDJSON can be multiplexed into one batch response
+    without parsing (or copying) the large image line.
+    """
+
+    def __init__(self, job):
+        self.tag = b'"job": %d' % job
+        self._at_line_start = True
+        self._held_brace = False  # A line's "{" ended the previous chunk
+
+    def _open_object(self, next_byte):
+        return b"{" + self.tag + (b"" if next_byte == b"}" else b", ")
+
+    @staticmethod
+    def _next_line_start(chunk, position):
+        newline = chunk.find(b"\n", position)
+        return -1 if newline < 0 else newline + 1
+
+    def feed(self, chunk):
+        if not chunk:
+            return chunk
+        pieces = []
+        copied = 0
+        if self._held_brace:
+            self._held_brace = False
+            pieces.append(self._open_object(chunk[:1]))
+            line_start = self._next_line_start(chunk, 0)
+        else:
+            line_start = 0 if self._at_line_start else self._next_line_start(chunk, 0)
+        while 0 <= line_start < len(chunk):
+            if chunk[line_start:line_start + 1] == b"{":
+                pieces.append(chunk[copied:line_start])
+                if line_start + 1 == len(chunk):
+                    self._held_brace = True
+                else:
+                    pieces.append(self._open_object(chunk[line_start + 1:line_start + 2]))
+                copied = line_start + 1
+            line_start = self._next_line_start(chunk, line_start)
+        pieces.append(chunk[copied:])
+        self._at_line_start = chunk.endswith(b"\n")
+        return b"".join(pieces)
+
+
+class BatchRun:
+    """
+    State of one /generate/batch request: its jobs, progress and results.
+    Running batches are registered by id so DELETE /generate/batch/<id> can
+    cancel the jobs that have not started yet.
+    """
+
+    _active = {}
+    _active_lock = threading.Lock()
+
+    def __init__(self, jobs, use_cache):
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.jobs = jobs
+        self.use_cache = use_cache
+        self.model = jobs[0].get("model", "")
+        self.ticket = None
+        self.cancelled = False
+        self.started = 0
+        self.results = {"completed": 0, "cached": 0, "failed": 0}
+
+    def register(self, ticket):
+        self.ticket = ticket
+        with self._active_lock:
+            self._active[self.batch_id] = self
+
+    def unregister(self):
+        with self._active_lock:
+            self._active.pop(self.batch_id, None)
+
+    @classmethod
+    def cancel(cls, batch_id):
+        """Stop a running batch after its current job; returns the number of jobs skipped, or None."""
+        with cls._active_lock:
+            batch = cls._active.get(batch_id)
+        if batch is None:
+            return None
+        batch.cancelled = True
+        GENERATION_SCHEDULER.withdraw(batch.ticket)  # Still queued: stop waiting for a slot
+        return len(batch.jobs) - batch.started
+
+    def pending_jobs(self):
+        """Yield (index, job) for each job still to run, until the batch is cancelled."""
+        for index, job in enumerate(self.jobs):
+            if self.cancelled:
+                return
+            self.started = index + 1
+            yield index, job
+
+    def header(self):
+        return {"batch": True, "batch_id": self.batch_id, "jobs": len(self.jobs)}
+
+    def cached_result(self, job):
+        """History id of an identical earlier generation for job, or None."""
+        image_name = find_cached_generation(job, self.use_cache)
+        if image_name:
+            self.results["cached"] += 1
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(self.model), "cached"))
+        return image_name
+
+    def finish_job(self, index, job, decoder):
+        """
+        Save a finished job's image to history and return its result line,
+        waiting for the write so the line never names an id that will not exist.
+        """
+        decoder.finish()
+        if not decoder.image_path:
+            return self.fail_job(index, "Ollama returned no image")
+        try:
+            image_name = save_generation_to_history(decoder.image_path, job)
+        except Exception as e:
+            print(f"Error saving to history: {e}", flush=True)
+            return self.fail_job(index, f"Error saving to history: {e}")
+        decoder.image_path = None
+        HISTORY_WRITER.wait(image_name)
+        failure = HISTORY_WRITER.failure(image_name)
+        if failure:
+            return self.fail_job(index, f"Error saving to history: {failure}")
+        self.results["completed"] += 1
+        METRIC_GENERATIONS.inc(labels=(metric_model_label(self.model), "completed"))
+        return {"job": index, "saved": True, "history_id": image_name}
+
+    def fail_job(self, index, message):
+        self.results["failed"] += 1
+        METRIC_GENERATIONS.inc(labels=(metric_model_label(self.model), "failed"))
+        return {"job": index, "error": message}
+
+    def summary(self):
+        return dict(self.results, batch_done=True, batch_id=self.batch_id,
+                    skipped=len(self.jobs) - self.started)
+
+
+class GenerationJob:
+    """
+    A generation that runs on the server whether or not anyone is watching,
+    so a reloaded page or dropped connection no longer throws the GPU's work
+    away. POST /jobs starts one; GET /jobs/<id>/stream follows it, as NDJSON
+    or server-sent events, from the start or from where a client left off.
+
+    Ollama's progress lines go into a ring of the last JOB_RING_SIZE lines,
+    numbered by offset. Each subscriber reads the ring at its own pace and
+    one that falls behind skips ahead, so no subscriber can hold up the
+    thread reading from Ollama. The final line, with the image, is not kept
+    in memory: each subscriber gets it rebuilt from the history PNG.
+    """
+
+    _jobs = {}  # Job id -> job, running and recently finished
+    _jobs_lock = threading.Lock()
+    runner = None  # Set by AsyncProxyServer to run jobs on its event loop instead of a thread each
+
+    def __init__(self, request_data, body):
+        self.job_id = uuid.uuid4().hex[:16]
+        self.request_data = request_data
+        self.body = body
+        self.model = request_data.get("model", "")
+        self.created = datetime.now().isoformat()
+        self.state = "queued"  # "queued", "running", "done" or "failed"
+        self.ticket = None
+        self.progress = None
+        self.done_fields = None
+        self.history_id = None
+        self.cached = False
+        self.error = None
+        self.finished_at = None
+        self._lines = deque(maxlen=JOB_RING_SIZE)  # (offset, line)
+        self._next_offset = 0  # Also the offset of the final line, once finished
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    @classmethod
+    def start(cls, request_data, body, use_cache):
+        """Start a job for a parsed /generate request; raises QueueFullError if the queue is full."""
+        job = cls(request_data, body)
+        cached_image_name = find_cached_generation(request_data, use_cache)
+        if cached_image_name:
+            print(f"✓ Job {job.job_id} served from cached generation: {cached_image_name}", flush=True)
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(job.model), "cached"))
+            job.cached = True
+            job._finish("done", history_id=cached_image_name)
+        else:
+            try:
+                job.ticket = GENERATION_SCHEDULER.submit(job.model)
+            except QueueFullError:
+                METRIC_GENERATIONS.inc(labels=(metric_model_label(job.model), "rejected"))
+                raise
+        with cls._jobs_lock:
+            cls._expire()
+            cls._jobs[job.job_id] = job
+        if job.ticket is not None:
+            if cls.runner is not None:
+                cls.runner(job)
+            else:
+                threading.Thread(target=job._run, name=f"job-{job.job_id}", daemon=True).start()
+        return job
+
+    @classmethod
+    def get(cls, job_id):
+        with cls._jobs_lock:
+            cls._expire()
+            return cls._jobs.get(job_id)
+
+    @classmethod
+    def all(cls):
+        with cls._jobs_lock:
+            cls._expire()
+            return list(cls._jobs.values())
+
+    @classmethod
+    def _expire(cls):
+        """Forget jobs that finished more than JOB_RETENTION seconds ago (caller holds _jobs_lock)."""
+        cutoff = time.monotonic() - JOB_RETENTION
+        for job_id, job in list(cls._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del cls._jobs[job_id]
+
+    def add_listener(self, callback):
+        """Call callback() (without the lock held) whenever the job has a new line or finishes."""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.remove(callback)
+
+    def read(self, offset):
+        """
+        Return (lines, finished): the (offset, line) pairs in the ring from
+        offset on, and whether the job had finished, in which case there is
+        nothing more to come but the final line.
+        """
+        with self._cond:
+            return [(n, line) for n, line in self._lines if n >= offset], self.finished_at is not None
+
+    def wait(self, offset, timeout):
+        """
+        Wait up to timeout seconds for a line at offset or for the job to
+        finish; returns False if neither happened.
+        """
+        with self._cond:
+            if self._next_offset <= offset and self.finished_at is None:
+                self._cond.wait(timeout)
+            return self._next_offset > offset or self.finished_at is not None
+
+    @property
+    def final_offset(self):
+        with self._cond:
+            return self._next_offset
+
+    def status(self):
+        position = GENERATION_SCHEDULER.position(self.ticket) if self.ticket is not None else 0
+        self._check_saved()
+        with self._cond:
+            return {
+                "job_id": self.job_id,
+                "state": self.state,
+                "model": self.model,
+                "prompt": self.request_data.get("prompt", ""),
+                "created": self.created,
+                "position": position,
+                "progress": self.progress,
+                "history_id": self.history_id,
+                "cached": self.cached,
+                "error": self.error,
+                "next_offset": self._next_offset,
+                "stream_url": f"/jobs/{self.job_id}/stream",
+            }
+
+    @staticmethod
+    def format_line(offset, line, sse):
+        """A ring line as sent to subscribers: tagged with its offset, as NDJSON or an SSE event."""
+        line = b'{"offset": %d%s%s' % (offset, b"" if line[1:2] == b"}" else b", ", line[1:])
+        if sse:
+            return b"id: %d\ndata: %s\n" % (offset, line)
+        return line
+
+    def iter_final_line(self, sse):
+        """
+        Yield the bytes of the job's last line: the done line, with the image
+        read back from the history, or the error.
+        """
+        offset = self.final_offset
+        if sse:
+            yield b"id: %d\ndata: " % offset
+        fields = {"offset": offset, "job_id": self.job_id}
+        if self.history_id:
+            HISTORY_WRITER.wait(self.history_id)  # The image may still be waiting to be written
+            self._check_saved()
+        image_path = resolve_history_path(self.history_id, ".png") if self.history_id else None
+        if self.error is None and self.history_id and not (image_path and image_path.exists()):
+            fields["error"] = "The generated image has been deleted from the history"
+        elif self.error is not None:
+            fields["error"] = self.error
+        else:
+            done = dict(self.done_fields or {"model": self.model, "response": "", "done": True,
+                                             "done_reason": "stop"})
+            done.pop("image", None)
+            fields.update(done)
+            if self.cached:
+                fields["cached"] = True
+            if self.history_id:
+                fields["history_id"] = self.history_id
+                yield from iter_history_done_line(self.history_id, fields)
+                if sse:
+                    yield b"\n"
+                return
+        yield (json.dumps(fields) + "\n").encode("utf-8")
+        if sse:
+            yield b"\n"
+
+    def _append(self, line):
+        with self._cond:
+            self._lines.append((self._next_offset, line))
+            self._next_offset += 1
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+    def _finish(self, state, history_id=None, error=None):
+        with self._cond:
+            self.state = state
+            self.history_id = history_id
+            if error is not None:
+                self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+    def _check_saved(self):
+        """Mark a finished job failed if its image could not be written to the history."""
+        failure = HISTORY_WRITER.failure(self.history_id) if self.history_id else None
+        if failure:
+            with self._cond:
+                if self.history_id:
+                    self.state = "failed"
+                    self.history_id = None
+                    self.error = f"Could not save the image: {failure}"
+
+    def _on_line(self, line):
+        """Decoder callback: keep progress lines in the ring; the done line is rebuilt at the end."""
+        line = line.strip()
+        if not line or ImageStreamDecoder.DONE_MARKER.search(line):
+            return
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.get("error"):
+            # Ollama gave up mid-stream; the final line carries its message
+            with self._cond:
+                self.error = f"Ollama error: {data['error']}"
+            return
+        if isinstance(data, dict) and "completed" in data:
+            with self._cond:
+                self.progress = {"completed": data.get("completed"), "total": data.get("total")}
+        self._append(line + b"\n")
+
+    def _run(self):
+        """Run the job on its own thread (threading mode; see AsyncProxyServer.run_job for asyncio)."""
+        ticket = self.ticket
+        outcome = "failed"
+        decoder = self._new_decoder()
+        try:
+            # Wait for a generation slot, recording queue position changes for subscribers
+            position = GENERATION_SCHEDULER.wait(ticket, 0)
+            last_position = None
+            while position:
+                if position != last_position:
+                    self._record_position(position)
+                    last_position = position
+                position = GENERATION_SCHEDULER.wait(ticket, QUEUE_POSITION_INTERVAL)
+            self._start_running()
+
+            METRIC_ACTIVE_STREAMS.inc()
+            try:
+                sent_at = time.monotonic()
+                with OLLAMA_BACKENDS.request("POST", "/generate", body=self.body.encode("utf-8"),
+                                             model=self.model) as response:
+                    for chunk in response.iter_chunks():
+                        if sent_at is not None:
+                            METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(self.model),))
+                            sent_at = None
+                        decoder.feed(chunk)
+                decoder.finish()
+            finally:
+                METRIC_ACTIVE_STREAMS.dec()
+            outcome = self._complete(decoder)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._close(decoder, outcome)
+
+    def _new_decoder(self):
+        decoder = ImageStreamDecoder()
+        decoder.on_line = self._on_line
+        return decoder
+
+    def _record_position(self, position):
+        self._append(json.dumps({"queued": True, "position": position}).encode("utf-8") + b"\n")
+
+    def _start_running(self):
+        with self._cond:
+            self.state = "running"
+        print(f'Calling Ollama API for job {self.job_id} with: {json.dumps(self.request_data, indent=4)}')
+
+    def _complete(self, decoder):
+        """Save a finished generation (its decoder already finished) and end the job; returns the outcome."""
+        record_generation_duration(self.ticket, self.request_data)
+        self.done_fields = decoder.done_fields
+        load_duration = (decoder.done_fields or {}).get("load_duration")
+        if load_duration:
+            GENERATION_SCHEDULER.record_load_time(self.ticket, load_duration / 1e9)
+
+        history_id = None
+        if decoder.image_path:
+            try:
+                history_id = save_generation_to_history(decoder.image_path, self.request_data)
+                decoder.image_path = None
+            except Exception as e:
+                print(f"Error saving to history: {e}", flush=True)
+                self.error = f"Could not save the image: {e}"
+        if history_id is None and self.error is None:
+            self.error = "Ollama returned no image"
+        self._finish("done" if history_id else "failed", history_id=history_id)
+        return "completed" if history_id else "failed"
+
+    def _fail(self, error):
+        if isinstance(error, OllamaHTTPError):
+            self._finish("failed", error=f"Ollama error: {error.reason}")
+        elif isinstance(error, OllamaConnectionError):
+            self._finish("failed", error=f"Failed to connect to Ollama: {str(error)}")
+        else:
+            self._finish("failed", error=f"Server error: {str(error)}")
+
+    def _close(self, decoder, outcome):
+        decoder.close()
+        METRIC_GENERATIONS.inc(labels=(metric_model_label(self.model), outcome))
+        GENERATION_SCHEDULER.release(self.ticket)
+        print(f"Job {self.job_id} {self.state}" + (f": {self.error}" if self.error else ""), flush=True)
+
+
+def job_stream_options(query, accept, last_event_id):
+    """
+    Return (offset, sse) for a /jobs/<id>/stream request. ?format=sse or an
+    Accept of text/event-stream asks for server-sent events; ?offset=N, or a
+    reconnecting EventSource's Last-Event-ID, resumes after lines already seen.
+    Raises ValueError for a malformed offset.
+    """
+    sse = query.get("format", [""])[0] == "sse" or "text/event-stream" in (accept or "")
+    offset = parse_query_int(query, "offset", 0)
+    if last_event_id:
+        offset = max(offset, int(last_event_id) + 1)
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    return offset, sse
+
+
+def parse_history_id(path):
+    """Extract and validate a history id from a request path."""
+    if not path.startswith("/history/"):
+        return None
+
+    image_name = path.split("/history/", 1)[1]
+    if image_name.endswith(".png"):
+        image_name = image_name[:-4]
+
+    if not image_name or not HISTORY_ID_PATTERN.fullmatch(image_name):
+        return None
+
+    return image_name
+
+
+def parse_query_int(query, name, default):
+    """Return an integer query parameter, or default if it is absent."""
+    values = query.get(name)
+    if not values or values[0] == "":
+        return default
+    return int(values[0])
+
+
+def parse_query_date(query, name, end=False):
+    """
+    Return an ISO date or date-time query parameter as a bound for history
+    timestamps, or None if it is absent. A bare date as the end of a range
+    includes the whole of that day.
+    """
+    values = query.get(name)
+    if not values or values[0] == "":
+        return None
+    bound = datetime.fromisoformat(values[0])
+    if end and len(values[0]) == 10:
+        bound += timedelta(days=1)
+    return bound.isoformat()
+
+
+def parse_byte_size(text):
+    """Parse a size such as 800M or 20G (powers of 1024; a bare number is bytes) for the command line."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", text, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r} (try 500M or 20G)")
+    return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(2).upper() or " "))
+
+
+def parse_byte_range(range_header, size):
+    """
+    Parse a single-range "bytes=" Range header.
+    Returns (start, end) inclusive, None if the header should be ignored,
+    or False if the range cannot be satisfied.
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            suffix_length = int(last)
+            if suffix_length <= 0:
+                return False
+            return max(size - suffix_length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def resolve_history_path(image_name, suffix):
+    """
+    Return the path of a history file: HISTORY_DIR/YYYY/MM/DD/<id><suffix>,
+    or the old flat HISTORY_DIR/<id><suffix> for an item not migrated yet
+    (or whose id has no date). Returns None for an invalid id, so a path
+    can never escape HISTORY_DIR.
+    """
+    if not image_name or not HISTORY_ID_PATTERN.fullmatch(image_name):
+        return None
+    flat_path = HISTORY_DIR / f"{image_name}{suffix}"
+    shard = history_shard(image_name)
+    if shard is None:
+        return flat_path
+    shard_path = HISTORY_DIR / shard / f"{image_name}{suffix}"
+    if not shard_path.exists() and flat_path.exists():
+        return flat_path
+    return shard_path
+
+
+def parse_history_filters(query):
+    """
+    Return the model and date filters of an export or bulk delete as keyword
+    arguments for select_history_items (?model=&from=&to=, as for /history/search).
+    """
+    return {
+        "model": query.get("model", [None])[0] or None,
+        "created_from": parse_query_date(query, "from"),
+        "created_to": parse_query_date(query, "to", end=True),
+    }
+
+
+def select_history_items(model=None, created_from=None, created_to=None):
+    """
+    History metadata matching every given filter, newest first, from the
+    in-memory index; created_from/created_to are ISO timestamps, to exclusive.
+    """
+    HISTORY_INDEX.refresh_if_stale()
+    history_items, _, _ = HISTORY_INDEX.page()
+    return [item for item in history_items
+            if (model is None or item.get("settings", {}).get("model") == model)
+            and (created_from is None or item.get("timestamp", "") >= created_from)
+            and (created_to is None or item.get("timestamp", "") < created_to)]
+
+
+def delete_history_items(image_names):
+    """
+    Delete history items in one pass: their files, then their entries in the
+    index, thumbnail cache, result cache and history database. Returns the
+    ids that had files to delete.
+    """
+    ensure_history_dir()
+    for image_name in image_names:
+        HISTORY_WRITER.wait(image_name)  # Or it would be written after being deleted
+    deleted = []
+    # Paths are resolved under the lock in case a migration is moving the files
+    with HISTORY_FILES_LOCK:
+        for image_name in image_names:
+            found = False
+            for suffix in (".png", ".json"):
+                try:
+                    resolve_history_path(image_name, suffix).unlink()
+                    found = True
+                except FileNotFoundError:
+                    pass
+            if found:
+                deleted.append(image_name)
+    HISTORY_INDEX.remove_many(image_names)
+    THUMBNAILER.remove_many(deleted)
+    for image_name in deleted:
+        RESULT_CACHE.forget(image_name)
+    HISTORY_WRITER.untrack(image_names)
+    try:
+        HISTORY_STORE.remove_many(image_names)
+    except sqlite3.Error as e:
+        print(f"Error removing {len(image_names)} items from the history database: {e}", flush=True)
+    return deleted
+
+
+def add_archive_file(archive, name, f, compress=True):
+    """Copy an open file into a zip or tar archive that is being streamed, a chunk at a time."""
+    stat = os.fstat(f.fileno())
+    if isinstance(archive, zipfile.ZipFile):
+        info = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.file_size = stat.st_size
+        info.external_attr = 0o644 << 16
+        with archive.open(info, "w") as member:
+            shutil.copyfileobj(f, member, STREAM_CHUNK_SIZE)
+    else:
+        info = tarfile.TarInfo(name)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        archive.addfile(info, f)
+
+
+def write_history_archive(fileobj, history_items, archive_format):
+    """
+    Write history items to fileobj as a zip or tar archive, each item's PNG
+    and JSON in its YYYY/MM/DD folder, as they are laid out in HISTORY_DIR.
+    Nothing is held in memory but the file being copied and nothing is seeked
+    back over, so the archive can go straight to a socket, however large.
+    Items deleted meanwhile are left out; returns the number written.
+    """
+    out = io.BufferedWriter(fileobj, STREAM_CHUNK_SIZE)  # Small headers go out with the data, not on their own
+    if archive_format == "zip":
+        archive = zipfile.ZipFile(out, "w")
+    else:
+        archive = tarfile.open(fileobj=out, mode="w|")
+    written = 0
+    with archive:
+        for item in history_items:
+            image_name = item["id"]
+            shard = history_shard(image_name)
+            folder = f"{shard.as_posix()}/" if shard else ""
+            try:
+                with open(resolve_history_path(image_name, ".png"), "rb") as image_file, \
+                        open(resolve_history_path(image_name, ".json"), "rb") as json_file:
+                    # PNGs are already compressed; deflating them again costs CPU for nothing
+                    add_archive_file(archive, f"{folder}{image_name}.png", image_file, compress=False)
+                    add_archive_file(archive, f"{folder}{image_name}.json", json_file)
+            except FileNotFoundError:
+                continue
+            written += 1
+    out.flush()
+    out.detach()
+    return written
+
+
+class RequestBodyReader(io.RawIOBase):
+    """Reads a request body of a known length from a handler's rfile, and never past its end."""
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._remaining <= 0:
+            return 0
+        data = self._rfile.read(min(len(buffer), self._remaining))
+        self._remaining = self._remaining - len(data) if data else 0
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class HistoryImport:
+    """
+    Adds the items in a history archive (as made by write_history_archive) to
+    the history as the archive is read. An item's PNG and JSON may come in
+    either order; it is saved once both have arrived, just as a generation is.
+    Ids already in the history are skipped, never overwritten, and other
+    files in the archive (thumbnails, the database) are ignored.
+    """
+
+    def __init__(self):
+        self._images = {}  # id -> temporary PNG path, waiting for its metadata
+        self._metadata = {}  # id -> metadata, waiting for its PNG
+        self._batch = []  # Saved items not yet in the history database
+        self.imported = 0
+        self.skipped = set()
+        self.failed = set()
+
+    def add_file(self, name, f):
+        """Take one file from the archive."""
+        parts = name.split("/")
+        image_name, dot, extension = parts[-1].rpartition(".")
+        if (any(part.startswith(".") for part in parts) or not dot or extension not in ("png", "json")
+                or not HISTORY_ID_PATTERN.fullmatch(image_name)):
+            return
+        if image_name in self.skipped or image_name in self.failed:
+            return
+        pending = self._images if extension == "png" else self._metadata
+        if image_name in pending:
+            return
+        if resolve_history_path(image_name, ".png").exists() or resolve_history_path(image_name, ".json").exists():
+            self.skipped.add(image_name)
+            self._discard(image_name)
+            return
 
+        try:
+            if extension == "png":
+                self._images[image_name] = self._spool_image(f)
+            else:
+                self._metadata[image_name] = self._read_metadata(image_name, f)
+        except ValueError as e:
+            print(f"Not importing {name}: {e}", flush=True)
+            self.failed.add(image_name)
+            self._discard(image_name)
+            return
+        if image_name in self._images and image_name in self._metadata:
+            self._save(image_name)
 
-def get_latest_log_message(level):
-    """Return the latest log message for a given level, or None if not found."""
-    log_path = Path(OLLAMA_LOG_LOCATION).expanduser()
-    if not log_path.exists():
-        return None
+    def close(self):
+        """Add the last items to the database and drop any that arrived without their pair."""
+        self._flush()
+        self.failed.update(self._images, self._metadata)
+        for image_name in list(self._images):
+            self._discard(image_name)
+        self._metadata.clear()
+
+    def summary(self):
+        return {"imported": self.imported, "skipped": len(self.skipped), "failed": len(self.failed)}
+
+    @staticmethod
+    def _spool_image(f):
+        """Copy a PNG from the archive to a temporary file in HISTORY_DIR, ready to be renamed into place."""
+        signature = f.read(len(PNG_SIGNATURE))
+        if signature != PNG_SIGNATURE:
+            raise ValueError("not a PNG image")
+        ensure_history_dir()
+        temp_path = HISTORY_DIR / f".import.{uuid.uuid4().hex}.png.tmp"
+        out = open(temp_path, "wb")
+        try:
+            with out:
+                out.write(signature)
+                shutil.copyfileobj(f, out, STREAM_CHUNK_SIZE)
+        except BaseException:
+            temp_path.unlink()
+            raise
+        return temp_path
+
+    @staticmethod
+    def _read_metadata(image_name, f):
+        item_data = json.loads(f.read())
+        if not isinstance(item_data, dict):
+            raise ValueError("metadata is not a JSON object")
+        item_data.pop("image", None)
+        item_data["id"] = image_name
+        return item_data
+
+    def _discard(self, image_name):
+        self._metadata.pop(image_name, None)
+        temp_path = self._images.pop(image_name, None)
+        if temp_path is not None:
+            try:
+                temp_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _save(self, image_name):
+        metadata = self._metadata.pop(image_name)
+        image_path = store_history_files(image_name, self._images.pop(image_name), metadata)
+        HISTORY_INDEX.add(image_name, metadata)
+        HISTORY_WRITER.track(image_name, metadata.get("timestamp"), image_path)
+        settings = metadata.get("settings")
+        cache_key = generation_cache_key(settings) if isinstance(settings, dict) else None
+        if cache_key:
+            RESULT_CACHE.store(cache_key, image_name)
+        self.imported += 1
+        self._batch.append(metadata)
+        if len(self._batch) >= HISTORY_IMPORT_BATCH:
+            self._flush()
+
+    def _flush(self):
+        try:
+            HISTORY_STORE.add_many(self._batch)
+        except sqlite3.Error as e:
+            print(f"Error adding {len(self._batch)} imported items to the history database: {e}", flush=True)
+        self._batch = []
 
+
+def import_history_archive(body, history_import):
+    """
+    Feed a zip or tar (optionally compressed) history archive from a buffered
+    file object to a HistoryImport. A tar is imported as it is read. A zip
+    keeps its directory at the end, so it is copied to a temporary file first
+    and read from there.
+    """
     try:
-        log_text = log_path.read_text(encoding="utf-8", errors="replace")
-    except Exception:
-        return None
+        if body.peek(4)[:4] == b"PK\x03\x04":
+            ensure_history_dir()
+            with tempfile.TemporaryFile(dir=HISTORY_DIR) as spool:
+                shutil.copyfileobj(body, spool, STREAM_CHUNK_SIZE)
+                spool.seek(0)
+                with zipfile.ZipFile(spool) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            with archive.open(info) as f:
+                                history_import.add_file(info.filename, f)
+        else:
+            with tarfile.open(fileobj=body, mode="r|*") as archive:
+                for info in archive:
+                    if info.isfile():
+                        history_import.add_file(info.name, archive.extractfile(info))
+    finally:
+        history_import.close()
 
-    pattern = re.compile(rf"level={re.escape(level)}[^\n]*?{LOG_MESSAGE_PATTERN}")
-    matches = list(pattern.finditer(log_text))
-    if not matches:
-        return None
-    return matches[-1].group(1)
 
+def negotiate_encoding(accept_encoding):
+    """
+    The content coding to use for an Accept-Encoding header: "br" (if the
+    brotli module is installed), "gzip", or None for an uncompressed response.
+    """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        name, _, value = params.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
 
-def ensure_history_dir():
-    """Ensure the history directory exists"""
-    HISTORY_DIR.mkdir(exist_ok=True)
 
+def compress_body(body, encoding, best=False):
+    """Compress a response body with "gzip" or "br"; best trades time for size, for bodies compressed once."""
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if best else COMPRESS_GZIP_LEVEL, mtime=0)
 
-def parse_history_id(path):
-    """Extract and validate a history id from a request path."""
-    if not path.startswith("/history/"):
-        return None
 
-    image_name = path.split("/history/", 1)[1]
-    if image_name.endswith(".png"):
-        image_name = image_name[:-4]
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header is "*" or lists etag (compared weakly, as RFC 9110 requires)."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any(tag.strip().removeprefix("W/") == bare for tag in if_none_match.split(","))
 
-    if not image_name or not HISTORY_ID_PATTERN.fullmatch(image_name):
-        return None
 
-    return image_name
+class StaticAsset:
+    """One version of a static file, with precompressed copies and an ETag for each."""
 
+    def __init__(self, body, content_type, stat):
+        self.content_type = content_type
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        self.variants = {None: (body, f'"{digest}"')}
+        for encoding in ("gzip", "br"):
+            if encoding == "br" and brotli is None:
+                continue
+            compressed = compress_body(body, encoding, best=True)
+            if len(compressed) < len(body):
+                self.variants[encoding] = (compressed, f'"{digest}-{encoding}"')
 
-def resolve_history_path(image_name, suffix):
-    """Resolve a history file path and ensure it stays under HISTORY_DIR."""
-    base_dir = HISTORY_DIR.resolve()
-    candidate = (base_dir / f"{image_name}{suffix}").resolve()
-    if base_dir not in candidate.parents:
-        return None
-    return candidate
+    def variant(self, encoding):
+        """(encoding, body, etag) for a content coding, falling back to the uncompressed body."""
+        if encoding not in self.variants:
+            encoding = None
+        return (encoding,) + self.variants[encoding]
+
+
+class StaticAssetCache:
+    """
+    Keeps the pages served from the server's folder (index.html, test.html)
+    in memory, compressed once per version. Each request only stats the file;
+    it is read and compressed again when its size or modification time changes.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, content_type):
+        """Return the current StaticAsset for a file; raises FileNotFoundError if it is missing."""
+        path = self.directory / name
+        stat = path.stat()
+        asset = self._assets.get(name)
+        if asset is not None and asset.signature == (stat.st_mtime_ns, stat.st_size):
+            return asset
+        with self._lock:
+            asset = self._assets.get(name)
+            if asset is None or asset.signature != (stat.st_mtime_ns, stat.st_size):
+                with open(path, "rb") as f:
+                    body = f.read()
+                # Stat the open file again: the body matches this signature even if it changed meanwhile
+                asset = StaticAsset(body, content_type, os.stat(path))
+                self._assets[name] = asset
+            return asset
+
+
+STATIC_ASSETS = StaticAssetCache(Path(__file__).parent)
 
 
 class ProxyHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         """Serve the index.html file"""
-        if self.path == "/" or self.path == "/index.html":
-            try:
-                html_file = Path(__file__).parent / "index.html"
-                with open(html_file, "rb") as f:
-                    content = f.read()
+        parsed = urlsplit(self.path)
+        path = parsed.path
+        query = parse_qs(parsed.query)
 
-                self.send_response(200)
-                self.send_header("Content-Type", "text/html; charset=utf-8")
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
-            except FileNotFoundError:
-                self.send_error(404, "index.html not found")
-        elif self.path == "/test.html":
+        if path == "/" or path == "/index.html":
+            self.send_static_asset("index.html", "text/html; charset=utf-8")
+        elif path == "/test.html":
+            self.send_static_asset("test.html", "text/html; charset=utf-8")
+        elif path == "/models":
             try:
-                html_file = Path(__file__).parent / "test.html"
-                with open(html_file, "rb") as f:
-                    content = f.read()
-
+                # Cached and refreshed in the background by MODEL_RESIDENCY
+                image_gen_model_list = MODEL_RESIDENCY.available_models()
                 self.send_response(200)
-                self.send_header("Content-Type", "text/html; charset=utf-8")
-                self.send_header("Content-Length", str(len(content)))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
-                self.wfile.write(content)
-            except FileNotFoundError:
-                self.send_error(404, "test.html not found")
-        elif self.path == "/models":
-            req = urllib.request.Request(
-                OLLAMA_API_URL + "/tags",
-                headers={"Content-Type": "application/json"}
-            )
-            try:
-                with urllib.request.urlopen(req) as response:
-                    data = json.loads(response.read().decode("utf-8"))
-                    # Filter models that have 'image' in their name
-                    image_gen_model_list = []
-                    for model in data["models"]:
-                        if model["name"] in IMAGE_GEN_MODEL_LIST:
-                            image_gen_model_list.append(model['name'])
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/json")
-                    self.send_header("Access-Control-Allow-Origin", "*")
-                    self.end_headers()
-                    self.wfile.write(json.dumps(image_gen_model_list).encode("utf-8"))
-            except urllib.error.HTTPError as e:
-                error_body = e.read() if e.fp else b""
+                self.wfile.write(json.dumps(image_gen_model_list).encode("utf-8"))
+            except OllamaHTTPError as e:
+                error_body = e.body
                 self.send_response(e.code)
                 self.send_header("Content-Type", e.headers.get("Content-Type", "application/json"))
                 self.send_header("Access-Control-Allow-Origin", "*")
@@ -137,7 +3675,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
                         "error": f"Ollama error: {e.reason}"
                     })
                     self.wfile.write(error_msg.encode())
-            except urllib.error.URLError as e:
+            except OllamaConnectionError as e:
                 error_msg = json.dumps({
                     "error": f"Failed to connect to Ollama: {str(e)}"
                 })
@@ -156,7 +3694,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(error_msg.encode())
 
-        elif self.path == "/ollamalog/warn":
+        elif path == "/ollamalog/warn":
             message = get_latest_log_message("WARN")
             if message is None:
                 error_msg = json.dumps({
@@ -177,7 +3715,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(response_data.encode("utf-8"))
 
-        elif self.path == "/ollamalog/info":
+        elif path == "/ollamalog/info":
             message = get_latest_log_message("INFO")
             if message is None:
                 error_msg = json.dumps({
@@ -198,29 +3736,76 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(response_data.encode("utf-8"))
 
-        elif self.path == "/history/index":
-            # Return JSON array of all history items
+        elif path == "/jobs":
+            jobs = sorted(GenerationJob.all(), key=lambda job: job.created, reverse=True)
+            self.send_json(200, [job.status() for job in jobs])
+
+        elif path.startswith("/jobs/"):
+            match = JOB_PATH_PATTERN.fullmatch(path)
+            job = GenerationJob.get(match.group(1)) if match else None
+            if job is None:
+                self.send_json(404, {"error": "No job with that id"})
+            elif match.group(2):
+                try:
+                    offset, sse = job_stream_options(query, self.headers.get("Accept"),
+                                                     self.headers.get("Last-Event-ID"))
+                except ValueError as e:
+                    self.send_json(400, {"error": f"Invalid stream parameters: {e}"})
+                    return
+                self.stream_job(job, offset, sse)
+            else:
+                self.send_json(200, job.status())
+
+        elif path == "/models/status":
+            self.send_json(200, MODEL_RESIDENCY.status())
+
+        elif path == "/backends":
+            # Health, load and latency of each Ollama backend
+            self.send_json(200, OLLAMA_BACKENDS.stats())
+
+        elif path == "/queue":
+            self.send_json(200, GENERATION_SCHEDULER.stats())
+
+        elif path == "/cache":
+            self.send_json(200, RESULT_CACHE.stats())
+
+        elif path == "/metrics":
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        elif path == "/history/index":
+            # Return a JSON array of history items (newest first), served from the in-memory index
             try:
-                ensure_history_dir()
-                history_items = []
+                offset = parse_query_int(query, "offset", 0)
+                limit = parse_query_int(query, "limit", None)
+                if offset < 0 or (limit is not None and limit < 0):
+                    raise ValueError("offset and limit must not be negative")
+            except ValueError as e:
+                self.send_json(400, {"error": f"Invalid paging parameters: {e}"})
+                return
 
-                # Find all .json files in history directory
-                for json_file in sorted(HISTORY_DIR.glob("*.json"), reverse=True):
-                    try:
-                        with open(json_file, 'r') as f:
-                            item_data = json.load(f)
-                            if "image" in item_data:
-                                item_data.pop("image")
-                            history_items.append(item_data)
-                    except Exception as e:
-                        print(f"Error reading {json_file}: {e}")
-                        continue
+            try:
+                HISTORY_INDEX.refresh_if_stale()
+                history_items, total, etag = HISTORY_INDEX.page(offset, limit)
 
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.send_header("Access-Control-Allow-Origin", "*")
-                self.end_headers()
-                self.wfile.write(json.dumps(history_items).encode("utf-8"))
+                if etag_matches(self.headers.get("If-None-Match"), etag):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Access-Control-Allow-Origin", "*")
+                    self.end_headers()
+                    return
+
+                self.send_json(200, history_items, {
+                    "ETag": etag,
+                    "Cache-Control": "no-cache",
+                    "X-Total-Count": str(total),
+                })
             except Exception as e:
                 error_msg = json.dumps({
                     "error": f"Failed to load history: {str(e)}"
@@ -231,15 +3816,116 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(error_msg.encode())
 
-        elif self.path.startswith("/history/"):
+        elif path == "/history/export":
+            # Download history as a zip or tar archive, optionally filtered (?format=zip|tar&model=&from=&to=)
+            archive_format = query.get("format", ["zip"])[0]
+            try:
+                if archive_format not in HISTORY_ARCHIVE_TYPES:
+                    raise ValueError(f"format must be one of {', '.join(HISTORY_ARCHIVE_TYPES)}")
+                filters = parse_history_filters(query)
+            except ValueError as e:
+                self.send_json(400, {"error": f"Invalid export parameters: {e}"})
+                return
+            history_items = select_history_items(**filters)
+            filename = f"history-{datetime.now():%Y%m%d-%H%M%S}.{archive_format}"
+            self.send_response(200)
+            self.send_header("Content-Type", HISTORY_ARCHIVE_TYPES[archive_format])
+            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("X-Total-Count", str(len(history_items)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            try:
+                # Oldest first, so an archive of everything reads like the history itself
+                written = write_history_archive(self.wfile, reversed(history_items), archive_format)
+            except (ConnectionError, BrokenPipeError):
+                print(f"History export to {self.client_address[0]} abandoned by the client", flush=True)
+                return
+            print(f"✓ Exported {written} history items as {filename}", flush=True)
+
+        elif path == "/history/search":
+            # Search history by prompt words and/or model, size and date (?q=&model=&width=&height=&from=&to=)
+            try:
+                offset = parse_query_int(query, "offset", 0)
+                limit = parse_query_int(query, "limit", HISTORY_SEARCH_DEFAULT_LIMIT)
+                if offset < 0 or not 0 <= limit <= HISTORY_SEARCH_MAX_LIMIT:
+                    raise ValueError(f"offset must not be negative and limit must be 0-{HISTORY_SEARCH_MAX_LIMIT}")
+                filters = {
+                    "text": query.get("q", [""])[0],
+                    "before": query.get("before", [None])[0] or None,
+                    "model": query.get("model", [None])[0] or None,
+                    "width": parse_query_int(query, "width", None),
+                    "height": parse_query_int(query, "height", None),
+                    "created_from": parse_query_date(query, "from"),
+                    "created_to": parse_query_date(query, "to", end=True),
+                }
+            except ValueError as e:
+                self.send_json(400, {"error": f"Invalid search parameters: {e}"})
+                return
+
+            try:
+                history_items, total = HISTORY_STORE.search(offset=offset, limit=limit, **filters)
+            except sqlite3.Error as e:
+                self.send_json(500, {"error": f"History search failed: {e}"})
+                return
+            for item in history_items:
+                item["image_url"] = f"/history/{item['id']}.png"
+            headers = {"Cache-Control": "no-cache", "X-Total-Count": str(total)}
+            if total >= HISTORY_SEARCH_COUNT_LIMIT:
+                headers["X-Total-Count-Capped"] = "true"
+            if history_items and len(history_items) == limit:
+                headers["X-Next-Before"] = history_items[-1]["id"]  # ?before= for the next page
+            self.send_json(200, history_items, headers)
+
+        elif path.startswith("/history/") and path.endswith("/thumb"):
+            # Thumbnail for the gallery (e.g., /history/20260123123453/thumb?size=256)
+            image_name = parse_history_id(path[:-len("/thumb")])
+            if not image_name:
+                self.send_error(400, "Invalid history id")
+                return
+
+            try:
+                size = Thumbnailer.snap_size(parse_query_int(query, "size", THUMBNAIL_DEFAULT_SIZE))
+            except ValueError:
+                self.send_error(400, "Invalid thumbnail size")
+                return
+
+            try:
+                HISTORY_WRITER.wait(image_name)
+                image_path = resolve_history_path(image_name, ".png")
+                if not image_path:
+                    self.send_error(400, "Invalid history path")
+                    return
+                if not image_path.exists():
+                    self.send_error(404, f"Image not found: {image_name}")
+                    return
+
+                thumbnail = THUMBNAILER.get_or_schedule(image_name, image_path, size)
+                if thumbnail is None:
+                    # Still being made: a tiny placeholder the gallery retries, never the full-size original
+                    self.send_response(202)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(THUMBNAIL_PLACEHOLDER)))
+                    self.send_header("Cache-Control", "no-store")
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Access-Control-Allow-Origin", "*")
+                    self.end_headers()
+                    self.wfile.write(THUMBNAIL_PLACEHOLDER)
+                    return
+                self.send_cached_file(*thumbnail)
+            except Exception as e:
+                self.send_json(500, {"error": f"Failed to create thumbnail: {str(e)}"})
+
+        elif path.startswith("/history/"):
             # Extract image name from path (e.g., /history/20260123123453)
-            image_name = parse_history_id(self.path)
+            image_name = parse_history_id(path)
             if not image_name:
                 self.send_error(400, "Invalid history id")
                 return
 
             try:
                 ensure_history_dir()
+                HISTORY_WRITER.wait(image_name)
                 image_path = resolve_history_path(image_name, ".png")
                 json_path = resolve_history_path(image_name, ".json")
                 if not image_path or not json_path:
@@ -250,9 +3936,10 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.send_error(404, f"Image not found: {image_name}")
                     return
 
-                # Read the image and encode to base64
-                with open(image_path, 'rb') as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
+                # /history/<id>.png returns the raw image, /history/<id> just the metadata
+                if path.endswith(".png"):
+                    self.send_cached_file(image_path, "image/png")
+                    return
 
                 # Read the JSON metadata if it exists
                 metadata = {}
@@ -260,19 +3947,14 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     with open(json_path, 'r') as f:
                         metadata = json.load(f)
 
-                # Return in the same format as local storage
                 response_data = {
-                    "image": image_data,
                     "settings": metadata.get("settings", {}),
                     "timestamp": metadata.get("timestamp", ""),
-                    "id": metadata.get("id", image_name)
+                    "id": metadata.get("id", image_name),
+                    "image_url": f"/history/{image_name}.png"
                 }
 
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.send_header("Access-Control-Allow-Origin", "*")
-                self.end_headers()
-                self.wfile.write(json.dumps(response_data).encode("utf-8"))
+                self.send_json(200, response_data)
             except Exception as e:
                 error_msg = json.dumps({
                     "error": f"Failed to load image: {str(e)}"
@@ -288,14 +3970,14 @@ class ProxyHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Proxy POST requests to Ollama API"""
+        self.stream_started = False
         if self.path == "/generate":
             try:
                 # Read the request body
                 content_length = int(self.headers.get("Content-Length", 0))
                 body = self.rfile.read(content_length)
                 try:
-                    request_data = json.loads(body)
-                    print(json.dumps(request_data, indent=4), flush=True)
+                    request_data, reformatted_body, use_cache = parse_generate_request(body)
                 except json.JSONDecodeError:
                     error_msg = json.dumps({
                         "error": "Invalid JSON body"
@@ -307,90 +3989,86 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.wfile.write(error_msg.encode())
                     return
 
-                # Convert any newline or carriage returns in the prompt to spaces.
-                request_data['prompt'] = request_data['prompt'].replace('\n', ' ').replace('\r', ' ')
-
-                reformatted_body = json.dumps(request_data)
+                # An identical seeded generation is already in the history: replay it
+                model = request_data.get("model", "")
+                cached_image_name = find_cached_generation(request_data, use_cache)
+                if cached_image_name:
+                    print(f"✓ Serving cached generation: {cached_image_name}", flush=True)
+                    METRIC_GENERATIONS.inc(labels=(metric_model_label(model), "cached"))
+                    self.send_stream_headers()
+                    for data in iter_cached_generation(cached_image_name, request_data):
+                        self.wfile.write(data)
+                        METRIC_STREAM_BYTES.inc(len(data), (metric_model_label(model),))
+                    self.wfile.flush()
+                    return
 
-                print(f'Calling Ollama API with: {json.dumps(request_data, indent=4)}')
+                # Wait for a generation slot, telling the client its queue position meanwhile
+                try:
+                    ticket = GENERATION_SCHEDULER.submit(model)
+                except QueueFullError as e:
+                    METRIC_GENERATIONS.inc(labels=(metric_model_label(model), "rejected"))
+                    self.send_json(429, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+                    return
 
-                # Forward the request to Ollama
-                req = urllib.request.Request(
-                    OLLAMA_API_URL + "/generate",
-                    data=reformatted_body.encode("utf-8"),
-                    headers={"Content-Type": "application/json"}
-                )
+                outcome = "failed"
+                try:
+                    if not self.wait_for_generation_slot(ticket):
+                        outcome = "abandoned"
+                        return
 
-                # Open connection to Ollama
-                with urllib.request.urlopen(req) as response:
-                    # Send response headers
-                    self.send_response(response.status)
-                    content_type = response.headers.get("Content-Type", "application/x-ndjson")
-                    self.send_header("Content-Type", content_type)
-                    self.send_header("Access-Control-Allow-Origin", "*")
-                    self.send_header("Cache-Control", "no-cache")
-                    self.send_header("X-Accel-Buffering", "no")
-                    self.end_headers()
+                    print(f'Calling Ollama API with: {json.dumps(request_data, indent=4)}')
+                    METRIC_ACTIVE_STREAMS.inc()
 
-                    # Stream line-delimited JSON to preserve progress updates
-                    # Also capture the final response to save to history
-                    final_image_data = None
-                    while True:
-                        line = response.readline()
-                        if not line:
-                            break
+                    # Forward the request to Ollama over a pooled keep-alive connection
+                    sent_at = time.monotonic()
+                    with OLLAMA_BACKENDS.request("POST", "/generate", body=reformatted_body.encode("utf-8"),
+                                                 model=model) as response:
+                        # Send response headers (unless they went out with the queue updates)
+                        if not self.stream_started:
+                            self.send_stream_headers(response.status,
+                                                     response.headers.get("Content-Type", "application/x-ndjson"))
 
-                        # Try to parse the line to check if it contains the final image
+                        # Pass Ollama's line-delimited JSON through to the client unchanged, chunk
+                        # by chunk, while the final image is decoded straight to a temporary file
+                        decoder = ImageStreamDecoder()
                         try:
-                            line_data = json.loads(line)
-                            if line_data.get('done') and line_data.get('image'):
-                                final_image_data = line_data.get('image')
-                        except Exception as e:
-                            print(f"Error parsing stream line: {e}", flush=True)
+                            for chunk in response.iter_chunks():
+                                if sent_at is not None:
+                                    METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(model),))
+                                    sent_at = None
+                                self.wfile.write(chunk)
+                                self.wfile.flush()
+                                METRIC_STREAM_BYTES.inc(len(chunk), (metric_model_label(model),))
+                                decoder.feed(chunk)
+                            decoder.finish()
+                            outcome = "completed"
+                            record_generation_duration(ticket, request_data)
 
-                        self.wfile.write(line)
-                        self.wfile.flush()
+                            load_duration = (decoder.done_fields or {}).get("load_duration")
+                            if load_duration:
+                                # Ollama reports durations in nanoseconds
+                                GENERATION_SCHEDULER.record_load_time(ticket, load_duration / 1e9)
 
-                    # Save to history if we got an image
-                    if final_image_data:
-                        try:
-                            ensure_history_dir()
-
-                            # Generate filename with timestamp
-                            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                            image_filename = f"{timestamp}.png"
-                            json_filename = f"{timestamp}.json"
-
-                            # Save the image
-                            image_path = HISTORY_DIR / image_filename
-                            with open(image_path, 'wb') as f:
-                                f.write(base64.b64decode(final_image_data))
-
-                            # Prepare metadata matching the local storage format
-                            metadata = {
-                                "id": timestamp,
-                                "timestamp": datetime.now().isoformat(),
-                                "settings": {
-                                    "model": request_data.get("model", ""),
-                                    "prompt": request_data.get("prompt", ""),
-                                    "seed": request_data.get("seed", 0),
-                                    "width": request_data.get("width", 512),
-                                    "height": request_data.get("height", 512),
-                                    "steps": request_data.get("steps", 12)
-                                }
-                            }
-
-                            # Save the metadata
-                            json_path = HISTORY_DIR / json_filename
-                            with open(json_path, 'w') as f:
-                                json.dump(metadata, f, indent=2)
-
-                            print(f"✓ Saved image to history: {image_filename}", flush=True)
-                        except Exception as e:
-                            print(f"Error saving to history: {e}", flush=True)
-
-            except urllib.error.HTTPError as e:
-                error_body = e.read() if e.fp else b""
+                            # Save to history if we got an image
+                            if decoder.image_path:
+                                try:
+                                    save_generation_to_history(decoder.image_path, request_data)
+                                    decoder.image_path = None
+                                except Exception as e:
+                                    print(f"Error saving to history: {e}", flush=True)
+                        finally:
+                            decoder.close()
+                finally:
+                    if outcome != "abandoned":
+                        METRIC_ACTIVE_STREAMS.dec()
+                    METRIC_GENERATIONS.inc(labels=(metric_model_label(model), outcome))
+                    GENERATION_SCHEDULER.release(ticket)
+
+            except OllamaHTTPError as e:
+                error_body = e.body
+                if self.stream_started:
+                    self.send_stream_error(f"Ollama error: {e.reason}")
+                    return
                 self.send_response(e.code)
                 self.send_header("Content-Type", e.headers.get("Content-Type", "application/json"))
                 self.send_header("Access-Control-Allow-Origin", "*")
@@ -403,7 +4081,10 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     })
                     self.wfile.write(error_msg.encode())
 
-            except urllib.error.URLError as e:
+            except OllamaConnectionError as e:
+                if self.stream_started:
+                    self.send_stream_error(f"Failed to connect to Ollama: {str(e)}")
+                    return
                 error_msg = json.dumps({
                     "error": f"Failed to connect to Ollama: {str(e)}"
                 })
@@ -414,6 +4095,9 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.wfile.write(error_msg.encode())
 
             except Exception as e:
+                if self.stream_started:
+                    self.send_stream_error(f"Server error: {str(e)}")
+                    return
                 error_msg = json.dumps({
                     "error": f"Server error: {str(e)}"
                 })
@@ -422,11 +4106,188 @@ class ProxyHandler(BaseHTTPRequestHandler):
                 self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
                 self.wfile.write(error_msg.encode())
+        elif self.path == "/generate/batch":
+            self.generate_batch()
+        elif self.path == "/jobs":
+            self.start_job()
+        elif self.path == "/history/import":
+            self.import_history()
+        elif self.path == "/history/delete":
+            self.delete_history()
         else:
             self.send_error(404, "Endpoint not found")
 
+    def import_history(self):
+        """Add the items in an uploaded history archive (zip or tar, as /history/export makes)"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length <= 0:
+            self.send_json(400, {"error": "Upload a zip or tar archive as the request body"})
+            return
+        body = io.BufferedReader(RequestBodyReader(self.rfile, content_length), STREAM_CHUNK_SIZE)
+        history_import = HistoryImport()
+        try:
+            import_history_archive(body, history_import)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error) as e:
+            self.send_json(400, {"error": f"Invalid history archive: {e}", **history_import.summary()})
+            return
+        summary = history_import.summary()
+        print(f"✓ Imported {summary['imported']} history items "
+              f"({summary['skipped']} already present, {summary['failed']} failed)", flush=True)
+        self.send_json(200, summary)
+
+    def delete_history(self):
+        """Delete many history items at once: {"ids": [...]} or {"filter": {"model", "from", "to"}}"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        try:
+            request_data = json.loads(self.rfile.read(content_length))
+            if not isinstance(request_data, dict):
+                raise ValueError("the body must be a JSON object")
+            if "ids" in request_data:
+                image_names = request_data["ids"]
+                if not isinstance(image_names, list) or not all(
+                        isinstance(image_name, str) and HISTORY_ID_PATTERN.fullmatch(image_name)
+                        for image_name in image_names):
+                    raise ValueError("ids must be a list of history ids")
+                image_names = list(dict.fromkeys(image_names))
+            elif isinstance(request_data.get("filter"), dict):
+                criteria = request_data["filter"]
+                filters = parse_history_filters({name: [criteria[name]] for name in ("model", "from", "to")
+                                                 if isinstance(criteria.get(name), str)})
+                if not any(filters.values()):
+                    raise ValueError("a filter needs a model, from or to (delete everything with a list of ids)")
+                image_names = [item["id"] for item in select_history_items(**filters)]
+            else:
+                raise ValueError('expected {"ids": [...]} or {"filter": {...}}')
+        except ValueError as e:
+            self.send_json(400, {"SUCCESS": False, "error": f"Invalid delete request: {e}"})
+            return
+
+        deleted = delete_history_items(image_names)
+        print(f"✓ Deleted {len(deleted)} history items", flush=True)
+        self.send_json(200, {"SUCCESS": True, "deleted": len(deleted), "not_found": len(image_names) - len(deleted)})
+
+    def start_job(self):
+        """Start a /generate request as a detached job and answer with its id straight away"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        try:
+            request_data, reformatted_body, use_cache = parse_generate_request(self.rfile.read(content_length))
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": "Invalid JSON body"})
+            return
+        except (KeyError, TypeError, AttributeError):
+            self.send_json(400, {"error": "A generate request needs a prompt"})
+            return
+        try:
+            job = GenerationJob.start(request_data, reformatted_body, use_cache)
+        except QueueFullError as e:
+            self.send_json(429, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+            return
+        self.send_json(202, job.status(), {"Location": f"/jobs/{job.job_id}"})
+
+    def stream_job(self, job, offset, sse):
+        """Follow a job from offset to its final line, as NDJSON or server-sent events"""
+        self.send_stream_headers(content_type="text/event-stream" if sse else "application/x-ndjson")
+        try:
+            while True:
+                lines, finished = job.read(offset)
+                for line_offset, line in lines:
+                    self.wfile.write(GenerationJob.format_line(line_offset, line, sse))
+                    offset = line_offset + 1
+                if finished:
+                    if offset <= job.final_offset:
+                        for data in job.iter_final_line(sse):
+                            self.wfile.write(data)
+                    self.wfile.flush()
+                    return
+                self.wfile.flush()
+                if not job.wait(offset, JOB_KEEPALIVE_INTERVAL) and sse:
+                    self.wfile.write(b": keep-alive\n\n")
+        except OSError:
+            print(f"Subscriber left job {job.job_id} at offset {offset}; the job carries on", flush=True)
+
+    def generate_batch(self):
+        """Run a /generate/batch sweep back to back in one generation slot, streaming tagged NDJSON"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        try:
+            batch = BatchRun(*parse_batch_request(self.rfile.read(content_length)))
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": f"Invalid batch request: {e}"})
+            return
+        try:
+            ticket = GENERATION_SCHEDULER.submit(batch.model)
+        except QueueFullError as e:
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(batch.model), "rejected"))
+            self.send_json(429, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+            return
+
+        batch.register(ticket)
+        METRIC_ACTIVE_STREAMS.inc()
+        try:
+            self.send_stream_headers()
+            self.send_stream_line(batch.header())
+            if not self.wait_for_generation_slot(ticket):
+                return
+            for index, job in batch.pending_jobs():
+                if not self.run_batch_job(batch, index, job):
+                    break
+            self.send_stream_line(batch.summary())
+        except OSError:
+            print(f"Client left batch {batch.batch_id}; skipping its remaining jobs", flush=True)
+        finally:
+            METRIC_ACTIVE_STREAMS.dec()
+            batch.unregister()
+            GENERATION_SCHEDULER.release(ticket)
+
+    def run_batch_job(self, batch, index, job):
+        """Stream one job of a batch; returns False if the rest of the batch cannot run."""
+        tagger = JobLineTagger(index)
+        cached_image_name = batch.cached_result(job)
+        if cached_image_name:
+            for data in iter_cached_generation(cached_image_name, job):
+                self.wfile.write(tagger.feed(data))
+            self.wfile.flush()
+            return True
+
+        decoder = ImageStreamDecoder()
+        try:
+            started_at = sent_at = time.monotonic()
+            with OLLAMA_BACKENDS.request("POST", "/generate", body=json.dumps(job).encode("utf-8"),
+                                         model=batch.model) as response:
+                for chunk in response.iter_chunks():
+                    if sent_at is not None:
+                        METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(batch.model),))
+                        sent_at = None
+                    self.wfile.write(tagger.feed(chunk))
+                    self.wfile.flush()
+                    METRIC_STREAM_BYTES.inc(len(chunk), (metric_model_label(batch.model),))
+                    decoder.feed(chunk)
+            decoder.finish()
+            record_generation_duration(batch.ticket, job, started_at)
+            load_duration = (decoder.done_fields or {}).get("load_duration")
+            if load_duration:
+                GENERATION_SCHEDULER.record_load_time(batch.ticket, load_duration / 1e9)
+            self.send_stream_line(batch.finish_job(index, job, decoder))
+        except OllamaHTTPError as e:
+            self.send_stream_line(batch.fail_job(index, f"Ollama error: {e.reason}"))
+        except OllamaConnectionError as e:
+            self.send_stream_line(batch.fail_job(index, f"Failed to connect to Ollama: {str(e)}"))
+            return False
+        finally:
+            decoder.close()
+        return True
+
     def do_DELETE(self):
-        """Handle DELETE requests for history items"""
+        """Handle DELETE requests for history items and running batches"""
+        if self.path.startswith("/generate/batch/"):
+            batch_id = self.path[len("/generate/batch/"):]
+            skipped = BatchRun.cancel(batch_id)
+            if skipped is None:
+                self.send_json(404, {"SUCCESS": False, "error": "No running batch with that id"})
+            else:
+                print(f"✓ Cancelled batch {batch_id} ({skipped} jobs skipped)", flush=True)
+                self.send_json(200, {"SUCCESS": True, "batch_id": batch_id, "skipped": skipped})
+            return
+
         if self.path.startswith("/history/"):
             # Extract image name from path (e.g., /history/20260123123453)
             image_name = parse_history_id(self.path)
@@ -444,6 +4305,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
 
             try:
                 ensure_history_dir()
+                HISTORY_WRITER.wait(image_name)
                 image_path = resolve_history_path(image_name, ".png")
                 json_path = resolve_history_path(image_name, ".json")
                 if not image_path or not json_path:
@@ -474,11 +4336,8 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.wfile.write(json.dumps(response_data).encode("utf-8"))
                     return
 
-                # Delete both files if they exist
-                if image_exists:
-                    image_path.unlink()
-                if json_exists:
-                    json_path.unlink()
+                # Delete both files if they exist, and the item from every index and cache
+                delete_history_items([image_name])
 
                 response_data = {"SUCCESS": True}
                 self.send_response(200)
@@ -508,28 +4367,909 @@ class ProxyHandler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "POST, GET, DELETE, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, If-None-Match, Range, Last-Event-ID")
+        self.send_header("Access-Control-Expose-Headers", "ETag, X-Total-Count, X-Total-Count-Capped, X-Next-Before, Content-Range")
+        self.end_headers()
+
+    def send_stream_headers(self, status=200, content_type="application/x-ndjson"):
+        """Start a streamed (unbuffered, uncached) NDJSON response"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("X-Accel-Buffering", "no")
+        self.end_headers()
+        self.stream_started = True
+
+    def send_stream_line(self, data):
+        """Write one JSON object as an NDJSON line and flush it to the client"""
+        self.wfile.write((json.dumps(data) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def send_stream_error(self, message):
+        """Report an error in-band once the streamed response has started"""
+        print(f"Stream error: {message}", flush=True)
+        try:
+            self.send_stream_line({"error": message})
+        except OSError:
+            pass
+
+    def wait_for_generation_slot(self, ticket):
+        """
+        Block until the scheduler admits ticket. While queued, stream the
+        client its position; returns False if the client went away.
+        """
+        position = GENERATION_SCHEDULER.wait(ticket, 0)
+        last_sent = None
+        last_sent_at = 0.0
+        while position:
+            now = time.monotonic()
+            if position != last_sent or now - last_sent_at >= QUEUE_POSITION_INTERVAL:
+                try:
+                    if not self.stream_started:
+                        self.send_stream_headers()
+                    self.send_stream_line({"queued": True, "position": position})
+                except OSError:
+                    print(f"Client left the queue at position {position}", flush=True)
+                    return False
+                last_sent, last_sent_at = position, now
+            position = GENERATION_SCHEDULER.wait(ticket, QUEUE_POSITION_INTERVAL)
+        return True
+
+    def send_cached_file(self, file_path, content_type):
+        """Stream a history file with validators, long-lived caching and Range support"""
+        stat = file_path.stat()
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, etag)
+        elif if_modified_since:
+            try:
+                not_modified = int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                not_modified = False
+
+        cache_headers = {
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Cache-Control": HISTORY_IMAGE_CACHE_CONTROL,
+        }
+        if not_modified:
+            self.send_response(304)
+            for name, value in cache_headers.items():
+                self.send_header(name, value)
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (not if_range or if_range in (etag, last_modified)):
+            byte_range = parse_byte_range(range_header, size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+
+        length = end - start + 1
+        with open(file_path, "rb") as f:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            for name, value in cache_headers.items():
+                self.send_header(name, value)
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            if length > 0:
+                self.send_file_range(f, start, length)
+
+    def send_file_range(self, f, start, length):
+        """Copy part of an open file to the client with sendfile()"""
+        self.wfile.flush()
+        self.connection.sendfile(f, start, length)
+
+    def send_json(self, status, data, extra_headers=None):
+        """Send a JSON response with CORS and Content-Length headers, compressed if the client accepts it"""
+        body = json.dumps(data).encode("utf-8")
+        headers = dict(extra_headers or {})
+        headers["Vary"] = "Accept-Encoding"
+        encoding = negotiate_encoding(self.headers.get("Accept-Encoding")) if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding:
+            body = compress_body(body, encoding)
+            headers["Content-Encoding"] = encoding
+            # The compressed bytes differ, so a strong validator would be wrong for them
+            if "ETag" in headers and not headers["ETag"].startswith("W/"):
+                headers["ETag"] = "W/" + headers["ETag"]
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_static_asset(self, name, content_type):
+        """Serve a file from STATIC_ASSETS in the best encoding the client accepts, answering revalidations with 304"""
+        try:
+            asset = STATIC_ASSETS.get(name, content_type)
+        except FileNotFoundError:
+            self.send_error(404, f"{name} not found")
+            return
+        encoding, body, etag = asset.variant(negotiate_encoding(self.headers.get("Accept-Encoding")))
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", STATIC_CACHE_CONTROL)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", asset.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", STATIC_CACHE_CONTROL)
+        self.send_header("Vary", "Accept-Encoding")
         self.end_headers()
+        self.wfile.write(body)
 
     def log_message(self, format, *args):
         """Custom log format"""
         print(f"[{self.log_date_time_string()}] {format % args}")
 
 
+class AsyncOllamaResponse:
+    """A streamed response from Ollama read with asyncio (one connection per request)."""
+
+    def __init__(self, status, reason, headers, reader, writer):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self.on_close = None  # Called once, when the response is closed
+
+    async def iter_chunks(self, size=STREAM_CHUNK_SIZE):
+        """Yield the body in pieces of at most size bytes, undoing chunked encoding."""
+        reader = self._reader
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), OLLAMA_READ_TIMEOUT)
+                chunk_size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if chunk_size == 0:
+                    return
+                remaining = chunk_size
+                while remaining:
+                    data = await asyncio.wait_for(reader.read(min(remaining, size)), OLLAMA_READ_TIMEOUT)
+                    if not data:
+                        raise OllamaConnectionError("connection closed mid-chunk")
+                    remaining -= len(data)
+                    yield data
+                await reader.readline()
+        else:
+            remaining = int(self.headers.get("content-length", -1))
+            while remaining != 0:
+                data = await asyncio.wait_for(reader.read(size if remaining < 0 else min(remaining, size)),
+                                              OLLAMA_READ_TIMEOUT)
+                if not data:
+                    return
+                remaining -= len(data) if remaining > 0 else 0
+                yield data
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    def close(self):
+        self._writer.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+
+async def open_ollama_stream(method, path, body=b"", model=None):
+    """
+    Send a request to the best Ollama backend for model without blocking the
+    event loop, failing over as OllamaBackendSet.request does; returns an
+    AsyncOllamaResponse.
+    """
+    error = None
+    for backend in OLLAMA_BACKENDS.candidates(model):
+        try:
+            return await backend.open_stream(method, path, body, model)
+        except OllamaConnectError as e:
+            error = e
+            OLLAMA_BACKENDS.log_failover(backend, e)
+    raise error
+
+
+async def open_backend_stream(base_url, method, path, body=b""):
+    """Send a request to one Ollama server with asyncio (a connection per request); returns an AsyncOllamaResponse."""
+    parts = urlsplit(base_url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=parts.scheme == "https"),
+            OLLAMA_CONNECT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        raise OllamaConnectError(f"{e or 'timed out'} ({base_url})") from e
+    METRIC_UPSTREAM_CONNECT.observe(time.monotonic() - started)
+    METRIC_UPSTREAM_REQUESTS.inc(labels=("false",))
+
+    try:
+        head = (f"{method} {parts.path.rstrip('/')}{path} HTTP/1.1\r\n"
+                f"Host: {parts.netloc}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), OLLAMA_READ_TIMEOUT)
+        _, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), OLLAMA_READ_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        writer.close()
+        raise OllamaConnectionError(str(e) or "timed out") from e
+
+    response = AsyncOllamaResponse(int(status), reason, headers, reader, writer)
+    if response.status >= 400:
+        try:
+            error_body = await response.read()
+        finally:
+            response.close()
+        raise OllamaHTTPError(response.status, reason, {"Content-Type": headers.get("content-type", "application/json")},
+                              error_body)
+    return response
+
+
+class LoopWriter(io.RawIOBase):
+    """A file-like object a worker thread can write to, feeding an asyncio stream with backpressure."""
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+        return len(data)
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+
+class BridgedProxyHandler(ProxyHandler):
+    """
+    Runs a ProxyHandler route on a worker thread in asyncio mode, reading a
+    request the event loop has already received (as bytes, or spooled to a
+    file) and writing through the loop.
+    """
+
+    def __init__(self, raw_request, loop, writer, client_address):
+        self._raw_request = raw_request
+        self._loop = loop
+        self._writer = writer
+        super().__init__(None, client_address, None)
+
+    def setup(self):
+        if isinstance(self._raw_request, bytes):
+            self.rfile = io.BytesIO(self._raw_request)
+        else:
+            self.rfile = self._raw_request
+        self.wfile = LoopWriter(self._loop, self._writer)
+
+    def finish(self):
+        pass
+
+    def send_file_range(self, f, start, length):
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(length, STREAM_CHUNK_SIZE))
+            if not data:
+                break
+            self.wfile.write(data)
+            length -= len(data)
+
+
+class AsyncProxyServer:
+    """
+    Serves the same routes as ProxyHandler on one asyncio event loop.
+    /generate, /generate/batch and /jobs/<id>/stream run natively, as do the
+    jobs started by POST /jobs: waiting in the queue, the upstream request to
+    Ollama and the streamed response cost a coroutine, not a thread. The
+    short routes (pages, history, models, logs) run the ProxyHandler code on
+    a small thread pool, which keeps blocking file I/O off the event loop.
+    """
+
+    MAX_HEADER_BYTES = 64 * 1024
+    STREAM_HEADERS = {"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    def __init__(self, port):
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS, thread_name_prefix="async-worker")
+        self._loop = None
+        self._queue_changed = None
+
+    async def serve_forever(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue_changed = asyncio.Event()
+        GENERATION_SCHEDULER.add_listener(lambda: self._loop.call_soon_threadsafe(self._signal_queue_change))
+        GenerationJob.runner = lambda job: asyncio.run_coroutine_threadsafe(self.run_job(job), self._loop)
+        server = await asyncio.start_server(self.handle_connection, "", self.port,
+                                            limit=self.MAX_HEADER_BYTES, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    def _signal_queue_change(self):
+        # Wake everyone waiting on the current event, and give later waiters a fresh one
+        self._queue_changed.set()
+        self._queue_changed = asyncio.Event()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername") or ("", 0)
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            request_line, _, header_block = head.decode("latin-1").partition("\r\n")
+            parts = request_line.split()
+            if len(parts) != 3:
+                await self.send_json(writer, 400, {"error": "Bad request line"})
+                return
+            method, target, _ = parts
+            headers = {}
+            for line in header_block.split("\r\n"):
+                name, sep, value = line.partition(":")
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+            try:
+                content_length = int(headers.get("content-length", 0))
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                await self.send_json(writer, 400, {"error": "Invalid Content-Length"})
+                return
+            url = urlsplit(target)
+            if method == "POST" and url.path == "/history/import":
+                # An archive upload can be any size: spool it to disk rather than memory
+                request = await self.spool_request(reader, head, content_length)
+                try:
+                    await self._loop.run_in_executor(self.executor, BridgedProxyHandler,
+                                                     request, self._loop, writer, client_address)
+                finally:
+                    request.close()
+                return
+            body = await reader.readexactly(content_length) if content_length else b""
+
+            job_match = JOB_PATH_PATTERN.fullmatch(url.path) if method == "GET" else None
+            if method == "POST" and url.path in ("/generate", "/generate/batch"):
+                print(f"[{datetime.now():%d/%b/%Y %H:%M:%S}] \"{request_line}\" (asyncio)", flush=True)
+                if url.path == "/generate":
+                    await self.generate(writer, body)
+                else:
+                    await self.generate_batch(writer, body)
+            elif job_match and job_match.group(2):
+                print(f"[{datetime.now():%d/%b/%Y %H:%M:%S}] \"{request_line}\" (asyncio)", flush=True)
+                await self.follow_job(writer, job_match.group(1), parse_qs(url.query), headers)
+            else:
+                await self._loop.run_in_executor(self.executor, BridgedProxyHandler,
+                                                 head + body, self._loop, writer, client_address)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"Error handling request from {client_address[0]}: {e}", flush=True)
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def spool_request(self, reader, head, content_length):
+        """Copy a request and its body to a temporary file, a chunk at a time; returns it rewound."""
+        spool = tempfile.TemporaryFile()
+        try:
+            spool.write(head)
+            remaining = content_length
+            while remaining:
+                data = await reader.read(min(remaining, STREAM_CHUNK_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                spool.write(data)
+                remaining -= len(data)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    async def send_head(self, writer, status, headers):
+        lines = [f"HTTP/1.0 {status} {HTTPStatus(status).phrase}",
+                 f"Date: {formatdate(usegmt=True)}",
+                 "Access-Control-Allow-Origin: *"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def send_json(self, writer, status, data, extra_headers=None):
+        body = json.dumps(data).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Content-Length": str(len(body))}
+        headers.update(extra_headers or {})
+        await self.send_head(writer, status, headers)
+        writer.write(body)
+        await writer.drain()
+
+    async def send_line(self, writer, data):
+        writer.write((json.dumps(data) + "\n").encode("utf-8"))
+        await writer.drain()
+
+    async def wait_for_generation_slot(self, writer, ticket, stream_headers=None):
+        """
+        Wait until the scheduler admits (or withdraws) ticket, streaming the
+        client its queue position. If stream_headers are given they are sent
+        before the first position line; returns True if they were sent.
+        """
+        headers_sent = False
+        last_sent = None
+        last_sent_at = 0.0
+        while True:
+            queue_changed = self._queue_changed
+            position = GENERATION_SCHEDULER.position(ticket)
+            if not position:
+                return headers_sent
+            now = time.monotonic()
+            if position != last_sent or now - last_sent_at >= QUEUE_POSITION_INTERVAL:
+                if stream_headers is not None and not headers_sent:
+                    await self.send_head(writer, 200, stream_headers)
+                    headers_sent = True
+                await self.send_line(writer, {"queued": True, "position": position})
+                last_sent, last_sent_at = position, now
+            try:
+                await asyncio.wait_for(queue_changed.wait(), QUEUE_POSITION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def generate(self, writer, body):
+        """The asyncio equivalent of ProxyHandler's /generate route."""
+        try:
+            request_data, reformatted_body, use_cache = parse_generate_request(body)
+            cached_image_name = find_cached_generation(request_data, use_cache)
+        except json.JSONDecodeError:
+            await self.send_json(writer, 400, {"error": "Invalid JSON body"})
+            return
+        except Exception as e:
+            await self.send_json(writer, 500, {"error": f"Server error: {str(e)}"})
+            return
+
+        stream_headers = self.STREAM_HEADERS
+        model = request_data.get("model", "")
+        if cached_image_name:
+            # An identical seeded generation is already in the history: replay it
+            print(f"✓ Serving cached generation: {cached_image_name}", flush=True)
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(model), "cached"))
+            await self.send_head(writer, 200, stream_headers)
+            pieces = iter_cached_generation(cached_image_name, request_data)
+            while True:
+                data = await self._loop.run_in_executor(self.executor, next, pieces, None)
+                if data is None:
+                    break
+                writer.write(data)
+                METRIC_STREAM_BYTES.inc(len(data), (metric_model_label(model),))
+                await writer.drain()
+            return
+
+        try:
+            ticket = GENERATION_SCHEDULER.submit(model)
+        except QueueFullError as e:
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(model), "rejected"))
+            await self.send_json(writer, 429, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+            return
+
+        stream_started = False
+        decoder = None
+        response = None
+        outcome = "abandoned"  # Until the ticket is admitted
+        try:
+            # Wait for a generation slot, telling the client its queue position meanwhile
+            stream_started = await self.wait_for_generation_slot(writer, ticket, stream_headers)
+
+            print(f'Calling Ollama API with: {json.dumps(request_data, indent=4)}')
+            outcome = "failed"
+            METRIC_ACTIVE_STREAMS.inc()
+            sent_at = time.monotonic()
+            response = await open_ollama_stream("POST", "/generate", reformatted_body.encode("utf-8"), model)
+            if not stream_started:
+                await self.send_head(writer, response.status,
+                                     dict(stream_headers, **{"Content-Type": response.headers.get(
+                                         "content-type", "application/x-ndjson")}))
+                stream_started = True
+
+            # Pass the stream through unchanged while decoding the final image to disk
+            decoder = ImageStreamDecoder()
+            async for chunk in response.iter_chunks():
+                if sent_at is not None:
+                    METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(model),))
+                    sent_at = None
+                writer.write(chunk)
+                METRIC_STREAM_BYTES.inc(len(chunk), (metric_model_label(model),))
+                await writer.drain()
+                # The decoder writes the image to disk, so it runs off the event loop
+                await self._loop.run_in_executor(self.executor, decoder.feed, chunk)
+            await self._loop.run_in_executor(self.executor, decoder.finish)
+            outcome = "completed"
+            record_generation_duration(ticket, request_data)
+
+            load_duration = (decoder.done_fields or {}).get("load_duration")
+            if load_duration:
+                GENERATION_SCHEDULER.record_load_time(ticket, load_duration / 1e9)
+            if decoder.image_path:
+                try:
+                    await self._loop.run_in_executor(self.executor, save_generation_to_history,
+                                                     decoder.image_path, request_data)
+                    decoder.image_path = None
+                except Exception as e:
+                    print(f"Error saving to history: {e}", flush=True)
+
+        except OllamaHTTPError as e:
+            if stream_started:
+                await self.send_line(writer, {"error": f"Ollama error: {e.reason}"})
+            else:
+                await self.send_head(writer, e.code, {"Content-Type": e.headers.get("Content-Type", "application/json")})
+                writer.write(e.body or json.dumps({"error": f"Ollama error: {e.reason}"}).encode())
+        except OllamaConnectionError as e:
+            message = f"Failed to connect to Ollama: {str(e)}"
+            if stream_started:
+                await self.send_line(writer, {"error": message})
+            else:
+                await self.send_json(writer, 502, {"error": message})
+        except ConnectionError:
+            print("Client disconnected during generation", flush=True)
+        except Exception as e:
+            message = f"Server error: {str(e)}"
+            if stream_started:
+                await self.send_line(writer, {"error": message})
+            else:
+                await self.send_json(writer, 500, {"error": message})
+        finally:
+            if response is not None:
+                response.close()
+            if decoder is not None:
+                decoder.close()
+            if outcome != "abandoned":
+                METRIC_ACTIVE_STREAMS.dec()
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(model), outcome))
+            GENERATION_SCHEDULER.release(ticket)
+
+    async def generate_batch(self, writer, body):
+        """The asyncio equivalent of ProxyHandler.generate_batch."""
+        try:
+            batch = BatchRun(*parse_batch_request(body))
+        except (ValueError, TypeError) as e:
+            await self.send_json(writer, 400, {"error": f"Invalid batch request: {e}"})
+            return
+        try:
+            ticket = GENERATION_SCHEDULER.submit(batch.model)
+        except QueueFullError as e:
+            METRIC_GENERATIONS.inc(labels=(metric_model_label(batch.model), "rejected"))
+            await self.send_json(writer, 429, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+            return
+
+        batch.register(ticket)
+        METRIC_ACTIVE_STREAMS.inc()
+        try:
+            await self.send_head(writer, 200, self.STREAM_HEADERS)
+            await self.send_line(writer, batch.header())
+            await self.wait_for_generation_slot(writer, ticket)
+            for index, job in batch.pending_jobs():
+                if not await self.run_batch_job(writer, batch, index, job):
+                    break
+            await self.send_line(writer, batch.summary())
+        except ConnectionError:
+            print(f"Client left batch {batch.batch_id}; skipping its remaining jobs", flush=True)
+        finally:
+            METRIC_ACTIVE_STREAMS.dec()
+            batch.unregister()
+            GENERATION_SCHEDULER.release(ticket)
+
+    async def run_batch_job(self, writer, batch, index, job):
+        """The asyncio equivalent of ProxyHandler.run_batch_job."""
+        tagger = JobLineTagger(index)
+        cached_image_name = batch.cached_result(job)
+        if cached_image_name:
+            pieces = iter_cached_generation(cached_image_name, job)
+            while True:
+                data = await self._loop.run_in_executor(self.executor, next, pieces, None)
+                if data is None:
+                    return True
+                writer.write(tagger.feed(data))
+                await writer.drain()
+
+        decoder = ImageStreamDecoder()
+        response = None
+        try:
+            started_at = sent_at = time.monotonic()
+            response = await open_ollama_stream("POST", "/generate", json.dumps(job).encode("utf-8"), batch.model)
+            async for chunk in response.iter_chunks():
+                if sent_at is not None:
+                    METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(batch.model),))
+                    sent_at = None
+                writer.write(tagger.feed(chunk))
+                METRIC_STREAM_BYTES.inc(len(chunk), (metric_model_label(batch.model),))
+                await writer.drain()
+                await self._loop.run_in_executor(self.executor, decoder.feed, chunk)
+            await self._loop.run_in_executor(self.executor, decoder.finish)
+            record_generation_duration(batch.ticket, job, started_at)
+            load_duration = (decoder.done_fields or {}).get("load_duration")
+            if load_duration:
+                GENERATION_SCHEDULER.record_load_time(batch.ticket, load_duration / 1e9)
+            result = await self._loop.run_in_executor(self.executor, batch.finish_job, index, job, decoder)
+            await self.send_line(writer, result)
+        except OllamaHTTPError as e:
+            await self.send_line(writer, batch.fail_job(index, f"Ollama error: {e.reason}"))
+        except OllamaConnectionError as e:
+            await self.send_line(writer, batch.fail_job(index, f"Failed to connect to Ollama: {str(e)}"))
+            return False
+        finally:
+            if response is not None:
+                response.close()
+            decoder.close()
+        return True
+
+
+    async def run_job(self, job):
+        """The asyncio equivalent of GenerationJob._run: a detached job as a task on the event loop."""
+        outcome = "failed"
+        decoder = job._new_decoder()
+        response = None
+        try:
+            last_position = None
+            while True:
+                queue_changed = self._queue_changed
+                position = GENERATION_SCHEDULER.position(job.ticket)
+                if not position:
+                    break
+                if position != last_position:
+                    job._record_position(position)
+                    last_position = position
+                try:
+                    await asyncio.wait_for(queue_changed.wait(), QUEUE_POSITION_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            job._start_running()
+
+            METRIC_ACTIVE_STREAMS.inc()
+            try:
+                sent_at = time.monotonic()
+                response = await open_ollama_stream("POST", "/generate", job.body.encode("utf-8"), job.model)
+                async for chunk in response.iter_chunks():
+                    if sent_at is not None:
+                        METRIC_FIRST_PROGRESS.observe(time.monotonic() - sent_at, (metric_model_label(job.model),))
+                        sent_at = None
+                    await self._loop.run_in_executor(self.executor, decoder.feed, chunk)
+                await self._loop.run_in_executor(self.executor, decoder.finish)
+            finally:
+                METRIC_ACTIVE_STREAMS.dec()
+            outcome = await self._loop.run_in_executor(self.executor, job._complete, decoder)
+        except Exception as e:
+            job._fail(e)
+        finally:
+            if response is not None:
+                response.close()
+            job._close(decoder, outcome)
+
+    async def follow_job(self, writer, job_id, query, headers):
+        """The asyncio equivalent of ProxyHandler.stream_job: a coroutine per subscriber, woken by the job."""
+        job = GenerationJob.get(job_id)
+        if job is None:
+            await self.send_json(writer, 404, {"error": "No job with that id"})
+            return
+        try:
+            offset, sse = job_stream_options(query, headers.get("accept"), headers.get("last-event-id"))
+        except ValueError as e:
+            await self.send_json(writer, 400, {"error": f"Invalid stream parameters: {e}"})
+            return
+
+        changed = asyncio.Event()
+        loop = self._loop
+
+        def on_change():
+            loop.call_soon_threadsafe(changed.set)
+
+        job.add_listener(on_change)
+        try:
+            await self.send_head(writer, 200, dict(self.STREAM_HEADERS, **{
+                "Content-Type": "text/event-stream" if sse else "application/x-ndjson"}))
+            while True:
+                changed.clear()
+                lines, finished = job.read(offset)
+                for line_offset, line in lines:
+                    writer.write(GenerationJob.format_line(line_offset, line, sse))
+                    offset = line_offset + 1
+                await writer.drain()
+                if finished:
+                    if offset <= job.final_offset:
+                        pieces = job.iter_final_line(sse)
+                        while True:
+                            data = await loop.run_in_executor(self.executor, next, pieces, None)
+                            if data is None:
+                                break
+                            writer.write(data)
+                            await writer.drain()
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), JOB_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if sse:
+                        writer.write(b": keep-alive\n\n")
+        except ConnectionError:
+            print(f"Subscriber left job {job.job_id} at offset {offset}; the job carries on", flush=True)
+        finally:
+            job.remove_listener(on_change)
+
+
+def run_history_migration():
+    started = time.monotonic()
+    print("🗂  Moving history into YYYY/MM/DD folders in the background...", flush=True)
+    try:
+        moved, left = migrate_flat_history()
+        print(f"✓ Moved {moved} history items into YYYY/MM/DD folders in {time.monotonic() - started:.2f}s", flush=True)
+    except OSError as e:
+        print(f"⚠️  History migration stopped: {e}", flush=True)
+
+
 def main():
-    server_address = ("", PORT)
-    httpd = ThreadingHTTPServer(server_address, ProxyHandler)
+    global PORT, OLLAMA_BACKEND_URLS, OLLAMA_BACKENDS, LOG_FOLLOWER
+    parser = argparse.ArgumentParser(description="Ollama Image Generator proxy server")
+    parser.add_argument("--backfill-thumbnails", action="store_true",
+                        help="create missing gallery thumbnails for the whole history, then exit")
+    parser.add_argument("--scheduling", choices=("fifo", "affinity"), default=SCHEDULING_MODE,
+                        help="order of queued generations: arrival order, or loaded model first to avoid model swaps")
+    parser.add_argument("--server", choices=("threading", "asyncio"), default=SERVER_MODE,
+                        help="a thread per connection, or one asyncio event loop for many concurrent streams")
+    parser.add_argument("--migrate-history", action="store_true",
+                        help="move history saved in the old flat layout into YYYY/MM/DD folders, then exit")
+    parser.add_argument("--import-history", action="store_true",
+                        help=f"rebuild the searchable history database ({HISTORY_DB_PATH.name}) from the JSON files, then exit")
+    parser.add_argument("--preload", action="append", default=[], metavar="MODEL",
+                        help="load this model into Ollama at startup (repeatable)")
+    parser.add_argument("--no-warming", action="store_true",
+                        help="do not load the most requested model while Ollama is idle")
+    parser.add_argument("--history-max-items", type=int, default=HISTORY_MAX_ITEMS, metavar="N",
+                        help="keep at most N history items, deleting the oldest")
+    parser.add_argument("--history-max-size", type=parse_byte_size, default=HISTORY_MAX_BYTES, metavar="SIZE",
+                        help="keep at most SIZE of history images and metadata (e.g. 500M, 20G), deleting the oldest")
+    parser.add_argument("--history-max-age", type=float, default=HISTORY_MAX_AGE_DAYS, metavar="DAYS",
+                        help="delete history items older than DAYS")
+    parser.add_argument("--port", type=int, default=PORT, help=f"port to serve on (default {PORT})")
+    parser.add_argument("--ollama-url", action="append",
+                        help=f"Ollama API base URL (default {', '.join(OLLAMA_BACKEND_URLS)}); "
+                             f"repeat to spread generations across several Ollama servers")
+    parser.add_argument("--ollama-log", default=OLLAMA_LOG_LOCATION,
+                        help="Ollama server log read by /ollamalog (default %(default)s)")
+    args = parser.parse_args()
+    GENERATION_SCHEDULER.mode = args.scheduling
+    PORT = args.port
+    if args.ollama_url:
+        OLLAMA_BACKEND_URLS = list(dict.fromkeys(url.rstrip("/") for url in args.ollama_url))
+        OLLAMA_BACKENDS = OllamaBackendSet(OLLAMA_BACKEND_URLS)
+    # Each backend has its own GPU, so the generation slots grow with the number of backends
+    GENERATION_SCHEDULER.max_concurrent = MAX_CONCURRENT_GENERATIONS * len(OLLAMA_BACKEND_URLS)
+    GENERATION_SCHEDULER.max_per_model = MAX_CONCURRENT_PER_MODEL * len(OLLAMA_BACKEND_URLS)
+    if args.ollama_log != OLLAMA_LOG_LOCATION:
+        LOG_FOLLOWER = OllamaLogFollower(args.ollama_log)
+    HISTORY_WRITER.max_items = args.history_max_items
+    HISTORY_WRITER.max_bytes = args.history_max_size
+    HISTORY_WRITER.max_age_days = args.history_max_age
+
+    if args.backfill_thumbnails:
+        ensure_history_dir()
+        print(f"🖼  Creating thumbnails ({'Pillow' if Image is not None else 'built-in PNG encoder'})...")
+        created, failed = THUMBNAILER.backfill()
+        print(f"✓ Created {created} thumbnails, {failed} failed")
+        return
+
+    if args.migrate_history:
+        started = time.monotonic()
+        ensure_history_dir()
+        print(f"🗂  Moving history in {HISTORY_DIR} into YYYY/MM/DD folders...")
+        moved, left = migrate_flat_history()
+        print(f"✓ Moved {moved} items ({left} without a date left in place) in {time.monotonic() - started:.2f}s")
+        return
+
+    if args.import_history:
+        started = time.monotonic()
+        print(f"🗃  Importing history into {HISTORY_DB_PATH}...")
+        imported, removed, failed = HISTORY_STORE.import_files(HISTORY_DIR)
+        print(f"✓ Imported {imported} items ({removed} stale removed, {failed} unreadable) "
+              f"in {time.monotonic() - started:.2f}s")
+        return
+
+    started = time.monotonic()
+    history_count = HISTORY_INDEX.build()
+    print(f"📚 Indexed {history_count} history items in {time.monotonic() - started:.2f}s")
+    if has_flat_history():
+        # Move the old flat layout into shards in the background; lookups work throughout
+        threading.Thread(target=run_history_migration, name="history-migration", daemon=True).start()
+    history_items, _, _ = HISTORY_INDEX.page()
+    RESULT_CACHE.populate(reversed(history_items))
+    try:
+        added, removed = HISTORY_STORE.sync(history_items)
+        if added or removed:
+            print(f"🗃  History database updated: {added} added, {removed} removed")
+    except sqlite3.Error as e:
+        print(f"⚠️  History database unavailable, /history/search will fail: {e}")
 
     print(f"🚀 Ollama Image Generator Server")
-    print(f"📡 Server running on http://localhost:{PORT}")
-    print(f"🔗 Proxying to Ollama at {OLLAMA_API_URL}")
+    print(f"📡 Server running on http://localhost:{PORT} ({args.server})")
+    print(f"🔗 Proxying to Ollama at {', '.join(OLLAMA_BACKEND_URLS)}")
+    print(f"🧮 Scheduling mode: {GENERATION_SCHEDULER.mode}")
+    limits = [f"{args.history_max_items} items" if args.history_max_items else None,
+              f"{args.history_max_size / 1024 ** 2:,.0f} MB" if args.history_max_size else None,
+              f"{args.history_max_age:g} days" if args.history_max_age else None]
+    if any(limits):
+        print(f"🧹 History kept to {', '.join(limit for limit in limits if limit)} (oldest deleted first)")
+    HISTORY_WRITER.start()
+    for model in args.preload:
+        if model not in MODEL_RESIDENCY.preload:
+            MODEL_RESIDENCY.preload.append(model)
+    MODEL_RESIDENCY.predictive = PREDICTIVE_WARMING and not args.no_warming
+    MODEL_RESIDENCY.start()
+    if MODEL_RESIDENCY.preload:
+        print(f"🔥 Preloading {', '.join(MODEL_RESIDENCY.preload)}")
     print(f"Press Ctrl+C to stop\n")
 
+    if args.server == "asyncio":
+        async_server = AsyncProxyServer(PORT)
+        try:
+            asyncio.run(async_server.serve_forever())
+        except KeyboardInterrupt:
+            print("\n\n👋 Server stopped")
+        finally:
+            async_server.executor.shutdown(wait=False)
+            HISTORY_WRITER.flush()
+            OLLAMA_BACKENDS.close()
+        return
+
+    server_address = ("", PORT)
+    httpd = ThreadingHTTPServer(server_address, ProxyHandler)
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n\n👋 Server stopped")
         httpd.shutdown()
+        HISTORY_WRITER.flush()
+        OLLAMA_BACKENDS.close()
 
 
 if __name__ == "__main__":